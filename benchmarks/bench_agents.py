@@ -0,0 +1,98 @@
+# Learner updates and action latency
+
+import torch as T
+from common import benchmark, time_per_call
+import agents
+import dqn
+import envs
+import utils
+
+BATCH_SIZES = (32, 128, 512)
+
+
+def mlp_agent():
+    '''
+        Tic Tac Toe agent (one hot states)
+    '''
+    return agents.DQNAgent(9, 9, dqn.MLP(27, 9, [256], flatten=True)), [27]
+
+
+def conn_agent():
+    '''
+        Connect4 agent (one hot states, channels first)
+    '''
+    return agents.DQNAgent(42, 7, dqn.Conn(3, 7)), [3, 7, 6]
+
+
+def learn_time(make_agent, batch_size, min_time):
+    agent, shape = make_agent()
+    states = T.rand([batch_size, *shape])
+    actions = T.randint(0, agent.n_action, [batch_size])
+    rewards = T.rand([batch_size])
+    dones = T.zeros([batch_size])
+
+    def step():
+        loss, _ = agent.get_loss(actions, states, states, rewards, dones)
+        agent.opti.zero_grad()
+        loss.backward()
+
+    return time_per_call(step, min_time) * 1e3
+
+
+def act_latency(make_agent, min_time, compiled, quantized=False):
+    '''
+    - compiled : Whether the agent acts with the compiled dqn
+    - quantized : Whether the agent acts with the int8 dqn
+    '''
+    agent, shape = make_agent()
+    agent.compile_after = 1 if compiled else 0
+    if quantized:
+        agent.quantize(T.rand([256, *shape]))
+    agent.exploration_rate = 0
+    state = T.rand([1, *shape])
+
+    return time_per_call(lambda: agent.act(state), min_time) * 1e6
+
+
+def int8_refresh(make_agent, min_time):
+    '''
+        Requantization of new weights, done by actors after weight syncs
+    '''
+    agent, shape = make_agent()
+    agent.quantize(T.rand([256, *shape]))
+
+    return time_per_call(agent.quantized.refresh, min_time) * 1e3
+
+
+for name, make_agent in (('mlp', mlp_agent), ('conn', conn_agent)):
+    for batch_size in BATCH_SIZES:
+        benchmark(f'agent.{name}.loss_backward_{batch_size}', 'ms', higher_is_better=False)(
+                lambda min_time, make_agent=make_agent, batch_size=batch_size:
+                learn_time(make_agent, batch_size, min_time))
+
+    benchmark(f'agent.{name}.act_latency', 'us', higher_is_better=False)(
+            lambda min_time, make_agent=make_agent: act_latency(make_agent, min_time, False))
+    benchmark(f'agent.{name}.act_latency_compiled', 'us', higher_is_better=False)(
+            lambda min_time, make_agent=make_agent: act_latency(make_agent, min_time, True))
+    benchmark(f'agent.{name}.act_latency_int8', 'us', higher_is_better=False)(
+            lambda min_time, make_agent=make_agent: act_latency(make_agent, min_time, False, True))
+    benchmark(f'agent.{name}.int8_refresh', 'ms', higher_is_better=False)(
+            lambda min_time, make_agent=make_agent: int8_refresh(make_agent, min_time))
+
+
+@benchmark('agent.mcts.connect4_simulations', 'sims/s')
+def mcts_simulations(min_time):
+    # Search of the first move, the tree is not reused
+    agent, _ = conn_agent()
+    agent.state_preprocessor = utils.f_one_hot_state(3, -1, channels_first=True)
+    mcts = agents.MCTSAgent(agent, envs.Connect4(), simulations=256)
+    state, _ = mcts.env.reset()
+
+    def search():
+        mcts.reset()
+        mcts.act(state)
+
+    t = time_per_call(search, min_time)
+
+    # Simulations backed up, the ones dropped on pending leaves don't count
+    return mcts.last_simulations / t
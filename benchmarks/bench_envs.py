@@ -0,0 +1,107 @@
+# Environments : moves per second and win checks
+
+import torch as T
+from common import benchmark, time_per_call
+import envs
+
+
+def random_games(env, n_games):
+    '''
+        Actions of n_games random games (legal actions only)
+    '''
+    games = []
+    act = env.random_act()
+    for _ in range(n_games):
+        state, _ = env.reset()
+        actions = []
+        done = False
+        while not done:
+            actions.append(act(state))
+            state, _, done, _ = env.step(actions[-1])
+        games.append(actions)
+
+    return games
+
+
+def moves_per_sec(env, min_time):
+    '''
+        Replays random games, only reset and step are measured
+    '''
+    games = random_games(env, 100)
+    n_moves = sum(len(g) for g in games)
+
+    def replay():
+        for actions in games:
+            env.reset()
+            for a in actions:
+                env.step(a)
+
+    return n_moves / time_per_call(replay, min_time)
+
+
+def vec_moves_per_sec(env, min_time):
+    '''
+        Random moves of all the games of a batched env
+    '''
+    act = env.random_act()
+    env.reset()
+
+    def step():
+        env.step(act(env.obs))
+
+    return env.n_envs / time_per_call(step, min_time)
+
+
+@benchmark('env.tic_tac_toe.step', 'moves/s')
+def tic_tac_toe_step(min_time):
+    return moves_per_sec(envs.TicTacToe(), min_time)
+
+
+@benchmark('env.connect4.step', 'moves/s')
+def connect4_step(min_time):
+    return moves_per_sec(envs.Connect4(), min_time)
+
+
+@benchmark('env.gomoku.step', 'moves/s')
+def gomoku_step(min_time):
+    return moves_per_sec(envs.Gomoku(), min_time)
+
+
+@benchmark('env.tic_tac_toe_vec_64.step', 'moves/s')
+def tic_tac_toe_vec_step(min_time):
+    return vec_moves_per_sec(envs.TicTacToeVec(64), min_time)
+
+
+@benchmark('env.connect4_vec_64.step', 'moves/s')
+def connect4_vec_step(min_time):
+    return vec_moves_per_sec(envs.Connect4Vec(64), min_time)
+
+
+@benchmark('env.connect4.winner', 'us', higher_is_better=False)
+def connect4_winner(min_time):
+    # Win check of the positions of random games
+    env = envs.Connect4()
+    masks = []
+    for actions in random_games(env, 20):
+        env.reset()
+        for a in actions:
+            env.step(a)
+            masks += env.masks
+
+    def check():
+        for mask in masks:
+            envs.Connect4.is_winning(mask)
+
+    return time_per_call(check, min_time) / len(masks) * 1e6
+
+
+@benchmark('env.connect4_vec_64.winners', 'us', higher_is_better=False)
+def connect4_vec_winners(min_time):
+    env = envs.Connect4Vec(64)
+    act = env.random_act()
+    env.reset()
+    for _ in range(10):
+        env.step(act(env.obs))
+    player_id = T.ones([env.n_envs], dtype=T.long)
+
+    return time_per_call(lambda: env.winners(player_id), min_time) * 1e6
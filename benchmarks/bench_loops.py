@@ -0,0 +1,77 @@
+# End to end training and testing
+
+import time
+from common import benchmark
+import agents
+import dqn
+import envs
+from log import Logger
+from mem import LinearMemory
+from utils import f_one_hot_state, f_legal_mask, train, test
+
+
+def tic_tac_toe_agent():
+    depth = 3
+    # Never displayed
+    log = Logger(10 ** 9)
+    ai = agents.DQNAgent(9, 9, dqn.MLP(27, 9, [256], flatten=True), logger=log,
+            state_preprocessor=f_one_hot_state(depth, -1, flatten=True),
+            legal_mask=f_legal_mask(envs.TicTacToe.legal_actions, depth, -1, flatten=True))
+    mem = LinearMemory(9, 200, ai.learn, state_preprocessor=ai.state_preprocessor)
+
+    return ai, mem, log
+
+
+def games_per_sec(play, games, min_time):
+    '''
+        play() plays a chunk of games
+    '''
+    play()
+
+    n = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < min_time:
+        play()
+        n += games
+
+    return n / (time.perf_counter() - start)
+
+
+def train_games_per_sec(env, rand_act, games, min_time):
+    ai, mem, log = tic_tac_toe_agent()
+
+    def play():
+        train(ai, rand_act, mem, env, games, log, False)
+
+    return games_per_sec(play, games, min_time)
+
+
+def test_games_per_sec(env, rand_act, games, min_time):
+    ai, _, _ = tic_tac_toe_agent()
+    ai.exploration_rate = 0
+    act = ai.act_batch if env.batched else ai.act
+
+    def play():
+        test(act, rand_act, env, games, ai.state_preprocessor)
+
+    return games_per_sec(play, games, min_time)
+
+
+@benchmark('loop.train.tic_tac_toe', 'games/s')
+def train_single(min_time):
+    return train_games_per_sec(envs.TicTacToe(), envs.TicTacToe.random_act(), 50, min_time)
+
+
+@benchmark('loop.train.tic_tac_toe_vec_64', 'games/s')
+def train_batched(min_time):
+    return train_games_per_sec(envs.TicTacToeVec(64), envs.TicTacToeVec.random_act(), 256, min_time)
+
+
+@benchmark('loop.test.tic_tac_toe', 'games/s')
+def test_single(min_time):
+    return test_games_per_sec(envs.TicTacToe(), envs.TicTacToe.random_act(), 50, min_time)
+
+
+@benchmark('loop.test.tic_tac_toe_vec_64', 'games/s')
+def test_batched(min_time):
+    return test_games_per_sec(envs.TicTacToeVec(64), envs.TicTacToeVec.random_act(), 256, min_time)
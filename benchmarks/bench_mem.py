@@ -0,0 +1,45 @@
+# Memories : trajectories added per second
+
+import torch as T
+from common import benchmark, time_per_call
+from mem import LinearMemory, ReplayMemory
+from utils import f_one_hot_state
+
+
+def adds_per_sec(mem, state_dim, min_time, raw):
+    n = 1000
+    states = T.randint(-1, 2, [n, *state_dim])
+    if not raw:
+        states = f_one_hot_state(3, -1, flatten=True)(states)
+    actions = T.randint(0, 9, [n]).tolist()
+
+    def add():
+        for i in range(n):
+            mem.add(actions[i], states[i], states[i], 0., False)
+
+    return n / time_per_call(add, min_time)
+
+
+@benchmark('mem.linear.add', 'adds/s')
+def linear_add(min_time):
+    # Nothing is learned
+    return adds_per_sec(LinearMemory(27, 200, lambda *_: None), [9], min_time, False)
+
+
+@benchmark('mem.linear.add_raw', 'adds/s')
+def linear_add_raw(min_time):
+    mem = LinearMemory(9, 200, lambda *_: None, state_preprocessor=f_one_hot_state(3, -1, flatten=True))
+
+    return adds_per_sec(mem, [9], min_time, True)
+
+
+@benchmark('mem.replay.add_batch_64', 'adds/s')
+def replay_add_batch(min_time):
+    n = 64
+    mem = ReplayMemory([7, 6], 10000, 32, lambda *_: None, replay_ratio=0,
+            state_preprocessor=f_one_hot_state(3, -1, channels_first=True))
+    states = T.randint(-1, 2, [n, 7, 6])
+    actions = T.randint(0, 7, [n])
+    rewards = T.zeros([n])
+
+    return n / time_per_call(lambda: mem.add_batch(actions, states, states, rewards, rewards), min_time)
@@ -0,0 +1,46 @@
+# Shared tools of the benchmarks
+
+import os
+import sys
+import time
+
+# The sources are not installed
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+# name -> (functor, unit, higher_is_better)
+BENCHMARKS = {}
+
+
+def benchmark(name, unit, higher_is_better=True):
+    '''
+        Decorator that registers a benchmark, the functor takes min_time
+    (seconds spent measuring) and returns the measure in unit
+    '''
+    def register(f):
+        BENCHMARKS[name] = (f, unit, higher_is_better)
+
+        return f
+
+    return register
+
+
+def time_per_call(f, min_time, repeat=3):
+    '''
+        Seconds per call of f, the best of repeat measures of at least min_time / repeat
+    * f is called once before measuring (warm up)
+    '''
+    f()
+
+    best = float('inf')
+    for _ in range(repeat):
+        n = 0
+        start = time.perf_counter()
+        elapsed = 0
+        while elapsed < min_time / repeat:
+            f()
+            n += 1
+            elapsed = time.perf_counter() - start
+
+        best = min(best, elapsed / n)
+
+    return best
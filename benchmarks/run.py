@@ -0,0 +1,87 @@
+# Runs the benchmarks
+#
+# python benchmarks/run.py                          Runs all benchmarks, saves benchmarks/results.json
+# python benchmarks/run.py -f connect4 -o new.json  Only the benchmarks containing 'connect4'
+# python benchmarks/run.py --compare base.json      Also compares with a previous results file
+
+import argparse
+import json
+import platform
+import time
+import torch as T
+from common import BENCHMARKS
+import bench_envs
+import bench_mem
+import bench_agents
+import bench_loops
+
+
+def run(names, min_time):
+    '''
+        Runs the benchmarks names
+    - Returns {name : {value, unit, higher_is_better}}
+    '''
+    results = {}
+    for name in names:
+        f, unit, higher_is_better = BENCHMARKS[name]
+        T.manual_seed(0)
+        value = f(min_time)
+        results[name] = {'value': value, 'unit': unit, 'higher_is_better': higher_is_better}
+
+        print(f'{name:<40} {value:12.2f} {unit}')
+
+    return results
+
+
+def compare(results, baseline, threshold):
+    '''
+        Displays the speedup of each benchmark against baseline
+    * Speedups > 1 are improvements (whatever the unit)
+    '''
+    print(f'\n{"Benchmark":<40} {"Baseline":>12} {"Current":>12} {"Speedup":>8}')
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+
+        old, new = baseline[name]['value'], result['value']
+        speedup = new / old if result['higher_is_better'] else old / new
+        status = ''
+        if speedup > 1 + threshold:
+            status = 'faster'
+        elif speedup < 1 - threshold:
+            status = 'REGRESSION'
+
+        print(f'{name:<40} {old:12.2f} {new:12.2f} {speedup:7.2f}x {status}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Q Board benchmarks (CPU)')
+    parser.add_argument('-o', '--output', default='benchmarks/results.json', help='JSON results file')
+    parser.add_argument('-c', '--compare', help='Baseline JSON results file')
+    parser.add_argument('-f', '--filter', default='', help='Runs the benchmarks containing this string')
+    parser.add_argument('-t', '--min-time', type=float, default=1., help='Seconds per benchmark')
+    parser.add_argument('--threads', type=int, default=1, help='Torch threads')
+    parser.add_argument('--threshold', type=float, default=.1, help='Speedup shown as significant')
+    args = parser.parse_args()
+
+    T.set_num_threads(args.threads)
+
+    names = [name for name in BENCHMARKS if args.filter in name]
+    results = run(names, args.min_time)
+
+    with open(args.output, 'w') as f:
+        json.dump({
+            'meta': {
+                'time': time.time(),
+                'python': platform.python_version(),
+                'torch': T.__version__,
+                'machine': platform.machine(),
+                'threads': args.threads,
+                'min_time': args.min_time,
+            },
+            'results': results,
+        }, f, indent=4)
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            compare(results, json.load(f)['results'], args.threshold)
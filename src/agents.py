@@ -1,8 +1,15 @@
+import copy
 import os
+import queue
+import threading
+import time
+from collections import OrderedDict
 from random import random, randint
 import torch as T
 from torch import optim, nn
 import torch.nn.functional as F
+from dqn import compile_inference, QuantizedDQN
+from profiler import DISABLED
 
 
 def make(agent, dqn, env, dqn_args=[], agent_args=[]):
@@ -20,7 +27,17 @@ class QAgent:
     '''
     def __init__(self, n_state, n_action, dqn, logger=None, lr=1e-3,
                 discount_factor=.98, exploration_decay=.99,
-                exploration_min=.05, state_preprocessor=lambda x: x):
+                exploration_min=.05, state_preprocessor=lambda x: x, cache_size=0, legal_mask=None,
+                compile_after=1000):
+        '''
+        - cache_size : Maximum number of cached Q values (see cached_act), 0 disables the cache
+        - legal_mask : Functor f(states) -> BoolTensor [batch, n_action], legal actions
+        of a batch of preprocessed states (see utils.f_legal_mask), used when acting
+        without mask and for the targets, None if all actions are legal
+        - compile_after : The Q values of act are computed by a compiled copy of dqn
+        (see dqn.compile_inference) after this number of calls without learning,
+        0 disables compilation (compiling takes ~10 ms, ~20 us are saved per call)
+        '''
         super().__init__()
 
         self.n_state = n_state
@@ -31,13 +48,32 @@ class QAgent:
         self.exploration_decay = exploration_decay
         self.exploration_min = exploration_min
         self.state_preprocessor = state_preprocessor
+        self.legal_mask = legal_mask
 
         self.exploration_rate = 1
         self.opti = optim.Adam(self.dqn.parameters(), lr=lr)
 
-    def get_loss(self, actions, states, next_states, rewards, dones):
+        # LRU cache of Q values, the keys are state hashes (cleared when learning)
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+        # Compiled copies of dqn by number of dimensions of the input, rebuilt lazily
+        self.compile_after = compile_after
+        self.compiled = {}
+        self.inference_calls = 0
+
+        # Int8 copy of dqn (see quantize), weight changes since its last refresh
+        self.quantized = None
+        self.quantize_refresh = 1
+        self.quantized_changes = 0
+
+    def get_loss(self, actions, states, next_states, rewards, dones, weights=None):
         '''
             Computes the loss, doesn't back prop
+        - weights : Importance sampling weights of each trajectory, None for uniform weights
+        - Returns loss, td_errors (detached q - q_target of each trajectory)
         '''
         raise NotImplementedError()
 
@@ -55,55 +91,621 @@ class QAgent:
         '''
         if os.path.exists(path):
             self.dqn.load_state_dict(T.load(path))
+            self.reset_inference()
             return True
         
         return False
 
-    def get_rewards(self, state):
-        return self.dqn(state)
+    def state_dict(self):
+        '''
+            Whole training state of the agent, dqn + optimizer + exploration
+        (see checkpoint.Checkpointer)
+        * The tensors are not copied
+        '''
+        return {
+            'dqn': self.dqn.state_dict(),
+            'opti': self.opti.state_dict(),
+            'exploration_rate': self.exploration_rate,
+        }
+
+    def load_state_dict(self, state):
+        self.dqn.load_state_dict(state['dqn'])
+        self.opti.load_state_dict(state['opti'])
+        self.exploration_rate = state['exploration_rate']
+        self.reset_inference()
+
+    def reset_inference(self):
+        '''
+            Must be called when the weights of dqn change, clears the
+        cached Q values and the compiled dqn
+        '''
+        self.cache.clear()
+        self.compiled.clear()
+        self.inference_calls = 0
+        self.quantized_changes += 1
+
+    def quantize(self, calibration_states, refresh=1, net=None):
+        '''
+            Acts with an int8 copy of dqn (see dqn.QuantizedDQN), made for
+        actors that don't learn
+        - calibration_states : Batch of preprocessed states (see utils.random_states)
+        - refresh : The copy is refreshed lazily (~5 ms) when the weights have
+        changed this number of times (see reset_inference), ie every refresh
+        weight syncs of train_parallel, by default it acts with the current weights
+        - net : Float dqn followed by the int8 copy instead of dqn, ie the shared
+        weights of train_parallel, the float weights of dqn are then unused
+        - Returns the rate of actions unchanged by quantization on calibration_states
+        * The activations are calibrated again when the weights drift (see dqn.QuantizedDQN)
+        !!! Only faster for convolutional dqns (~2x on CPU), the int8 copy of
+        a small MLP is slower than the compiled float dqn (~33 vs ~22 us per
+        action, see benchmarks), don't quantize MLP sized dqns
+        '''
+        self.quantized = QuantizedDQN(self.dqn if net is None else net, calibration_states)
+        self.quantize_refresh = refresh
+        self.quantized_changes = 0
+
+        return self.quantized.agreement()
+
+    def refresh_quantized(self):
+        '''
+            Refreshes the int8 copy if the weights changed refresh times (see quantize),
+        called lazily by infer
+        * Called when the followed weights can't change if they are shared
+        '''
+        if self.quantized is not None and self.quantized_changes >= self.quantize_refresh:
+            self.quantized.refresh()
+            self.quantized_changes = 0
+
+    def infer(self, state):
+        '''
+            Q values without gradient, computed by the int8 dqn if any (see quantize),
+        or by the compiled dqn when the weights didn't change for compile_after calls
+        '''
+        if self.quantized is not None:
+            self.refresh_quantized()
+
+            return self.quantized(state)
+
+        self.inference_calls += 1
+        if self.compile_after == 0 or self.inference_calls < self.compile_after:
+            with T.no_grad():
+                return self.dqn(state)
+
+        net = self.compiled.get(state.dim())
+        if net is None:
+            net = self.compiled[state.dim()] = compile_inference(self.dqn, state)
+
+        with T.inference_mode():
+            return net(state)
+
+    def get_rewards(self, state, key=None):
+        '''
+            Q values used to act (without gradient)
+        - key : Hash of the state (see BoardEnv.obs_hash), if given the Q values are cached
+        '''
+        if key is None or self.cache_size == 0:
+            return self.infer(state)
+
+        rewards = self.cache.get(key)
+        if rewards is not None:
+            self.cache_hits += 1
+            self.cache.move_to_end(key)
+
+            return rewards
+
+        self.cache_misses += 1
+        rewards = self.infer(state)
+
+        self.cache[key] = rewards
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+        return rewards
+
+    def act(self, state, key=None, mask=None):
+        '''
+        - mask : BoolTensor [n_action], only legal actions are played
+        (see BoardEnv.legal_mask), computed with legal_mask by default
+        '''
+        if mask is None and self.legal_mask is not None:
+            mask = self.legal_mask(state.unsqueeze(0))[0]
 
-    def act(self, state):
         if random() < self.exploration_rate:
-            return randint(0, self.n_action - 1)
-        
-        return T.argmax(self.get_rewards(state)).detach().item()
+            if mask is None:
+                return randint(0, self.n_action - 1)
+
+            return T.multinomial(mask.to(T.float32), 1).item()
+
+        rewards = self.get_rewards(state, key)
+        if mask is not None:
+            rewards = rewards.masked_fill(~mask, -float('inf'))
 
-    def learn(self, actions, states, next_states, rewards, dones):
+        return T.argmax(rewards).item()
+
+    def cached_act(self, env):
+        '''
+            Functor f(state) -> action, same as act but the Q values are cached
+        using the hash of the states given by env
+        !!! env must be the environment that returned state (not a copy)
+        '''
+        return lambda state: self.act(state, env.obs_hash)
+
+    def cache_hit_rate(self):
+        '''
+            Ratio of Q values read from the cache
+        '''
+        total = self.cache_hits + self.cache_misses
+
+        return 0 if total == 0 else self.cache_hits / total
+
+    def act_batch(self, states, masks=None):
+        '''
+            Batched version of act
+        - states : Preprocessed states, the first dimension is the batch
+        - masks : BoolTensor [batch, n_action] of the legal actions
+        - Returns a LongTensor of actions
+        '''
+        if masks is None and self.legal_mask is not None:
+            masks = self.legal_mask(states)
+
+        rewards = self.get_rewards(states)
+        if masks is not None:
+            rewards = rewards.masked_fill(~masks, -float('inf'))
+        actions = T.argmax(rewards, 1)
+
+        explore = T.rand(actions.shape) < self.exploration_rate
+        if masks is None:
+            actions[explore] = T.randint(0, self.n_action, [int(explore.sum())])
+        elif explore.any():
+            actions[explore] = T.multinomial(masks[explore].to(T.float32), 1).squeeze(1)
+
+        return actions
+
+    def learn(self, actions, states, next_states, rewards, dones, weights=None):
         '''
             Learns from trajectories
+        - weights : Importance sampling weights of each trajectory (optional)
+        - Returns the absolute TD errors, used as priorities by the memory
         * states and next_states are already preprocessed
         '''
         # TODO : Exploration rate change here ?
         self.exploration_rate = min(self.exploration_rate * self.exploration_decay, self.exploration_min)
 
-        loss = self.get_loss(actions, states, next_states, rewards, dones)
+        profiler = self.logger.profiler if self.logger else DISABLED
+
+        with profiler.phase('forward'):
+            loss, td_errors = self.get_loss(actions, states, next_states, rewards, dones, weights)
 
         if self.logger:
-            self.logger.losses.append(loss)
+            self.logger.record_loss(loss.item())
 
-        self.opti.zero_grad()
-        loss.backward()
-        self.opti.step()
+        with profiler.phase('backward'):
+            self.opti.zero_grad()
+            loss.backward()
+        with profiler.phase('optimizer step'):
+            self.opti.step()
+
+        # The Q values have changed
+        self.reset_inference()
+
+        return td_errors.abs()
         
 
 class DQNAgent(QAgent):
     '''
         Simple Deep Q Network
     '''
-    def __init__(self, n_state, n_action, dqn, *args, **kwargs):
+    def __init__(self, n_state, n_action, dqn, *args, target_freq=0, tau=1., fused=False, **kwargs):
         '''
-            Args are super args
+        - target_freq : If > 0, the targets are computed by a frozen copy of dqn
+        updated every target_freq learning steps
+        - tau : Update rate of the target network, 1 copies dqn, lower values
+        are Polyak averages (target = tau * dqn + (1 - tau) * target)
+        - fused : If True (and there is no target network), states and next_states
+        are evaluated with a single forward pass
+        * Other args are super args
         '''
         super().__init__(n_state, n_action, dqn, *args, **kwargs)
 
-    def get_loss(self, actions, states, next_states, rewards, dones):
+        self.target_freq = target_freq
+        self.tau = tau
+        self.fused = fused
+        self.learn_steps = 0
+
+        self.target_dqn = None
+        if target_freq > 0:
+            self.target_dqn = copy.deepcopy(dqn).requires_grad_(False)
+
+    def load(self, path):
+        loaded = super().load(path)
+
+        if loaded and self.target_dqn is not None:
+            self.target_dqn.load_state_dict(self.dqn.state_dict())
+
+        return loaded
+
+    def state_dict(self):
+        state = super().state_dict()
+        state['learn_steps'] = self.learn_steps
+        if self.target_dqn is not None:
+            state['target_dqn'] = self.target_dqn.state_dict()
+
+        return state
+
+    def load_state_dict(self, state):
+        super().load_state_dict(state)
+        self.learn_steps = state['learn_steps']
+        if self.target_dqn is not None:
+            self.target_dqn.load_state_dict(state['target_dqn'])
+
+    def update_target(self):
+        '''
+            Moves the target network towards dqn (see tau)
+        '''
+        with T.no_grad():
+            for target, param in zip(self.target_dqn.state_dict().values(), self.dqn.state_dict().values()):
+                if target.is_floating_point():
+                    target.lerp_(param, self.tau)
+                else:
+                    target.copy_(param)
+
+    def learn(self, actions, states, next_states, rewards, dones, weights=None):
+        td_errors = super().learn(actions, states, next_states, rewards, dones, weights)
+
+        self.learn_steps += 1
+        if self.target_dqn is not None and self.learn_steps % self.target_freq == 0:
+            self.update_target()
+
+        return td_errors
+
+    def get_loss(self, actions, states, next_states, rewards, dones, weights=None):
+        if self.fused and self.target_dqn is None:
+            # Both batches at once, the next Q values are not back propagated
+            q_values, next_q_values = self.dqn(T.cat([states, next_states])).split(len(states))
+            next_q_values = next_q_values.detach()
+        else:
+            q_values = self.dqn(states)
+            with T.no_grad():
+                next_q_values = (self.dqn if self.target_dqn is None else self.target_dqn)(next_states)
+
         # Predicted Q values
-        q = (self.dqn(states) * F.one_hot(actions, self.n_action)).sum(1)
+        q = (q_values * F.one_hot(actions, self.n_action)).sum(1)
+
+        # The target Q values, the max is taken over the legal actions
+        if self.legal_mask is not None:
+            next_q_values = next_q_values.masked_fill(~self.legal_mask(next_states), -float('inf'))
+        # Full boards have no legal action (finished games)
+        next_q = T.max(next_q_values, 1)[0].nan_to_num(neginf=0.)
+
+        q_target = rewards + self.discount_factor * (1 - dones) * next_q
 
-        # The target Q values
-        q_target = rewards + self.discount_factor * (1 - dones) * T.max(self.dqn(next_states), 1)[0]
+        if weights is None:
+            loss = F.mse_loss(q, q_target).mean()
+            # loss = F.smooth_l1_loss(q, q_target).mean()
+        else:
+            loss = (weights * F.mse_loss(q, q_target, reduction='none')).mean()
+
+        return loss, (q - q_target).detach()
+
+
+class InferenceBatcher:
+    '''
+        Serves the actions of an agent to concurrent games (threads),
+    the pending states are stacked and evaluated with a single forward pass
+    !!! The agent must not learn while it is served, unless the learning thread
+    holds lock (ie with batcher.lock: agent.learn(...)), learn changes the
+    weights and clears the inference caches (see QAgent.reset_inference)
+    '''
+    def __init__(self, agent, max_batch_size=64, max_wait=1e-3):
+        '''
+        - max_batch_size : Maximum number of states per forward pass
+        - max_wait : Maximum time (s) to wait for other states after the first one
+        '''
+        super().__init__()
+
+        self.agent = agent
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+
+        # Held by the server during a forward pass
+        self.lock = threading.Lock()
+
+        # Requests : [state, event, action, exception], None stops the server
+        self.requests = queue.Queue()
+        # No request is queued once closed, __closing makes the check and the put atomic
+        self.closed = False
+        self.__closing = threading.Lock()
+        self.thread = threading.Thread(target=self.__serve, daemon=True)
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def act(self, state):
+        '''
+            Functor f(state) -> action, like QAgent.act but thread safe
+        * state is preprocessed
+        * Raises the exception of the forward pass of the batch of state if any,
+        RuntimeError if the batcher is closed
+        '''
+        request = [state, threading.Event(), None, None]
+        with self.__closing:
+            if self.closed:
+                raise RuntimeError('InferenceBatcher is closed')
+            self.requests.put(request)
+        request[1].wait()
+
+        if request[3] is not None:
+            raise request[3]
+
+        return request[2]
+
+    def close(self):
+        '''
+            Stops the server once the requests queued before are served
+        '''
+        with self.__closing:
+            if self.closed:
+                return
+            self.closed = True
+            self.requests.put(None)
+        self.thread.join()
+
+        # Requests behind the stop request are not served, their callers must not wait
+        try:
+            while True:
+                request = self.requests.get_nowait()
+                if request is not None:
+                    request[3] = RuntimeError('InferenceBatcher is closed')
+                    request[1].set()
+        except queue.Empty:
+            pass
+
+    def __serve(self):
+        stop = False
+        while not stop:
+            request = self.requests.get()
+            if request is None:
+                return
+
+            # Gather other requests until the batch is full or max_wait is elapsed
+            batch = [request]
+            deadline = time.perf_counter() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                try:
+                    request = self.requests.get(timeout=max(0, deadline - time.perf_counter()))
+                except queue.Empty:
+                    break
+
+                if request is None:
+                    stop = True
+                    break
+
+                batch.append(request)
+
+            # The callers of a failed batch receive its exception, the server keeps serving
+            try:
+                with self.lock:
+                    actions = self.agent.act_batch(T.stack([request[0] for request in batch])).tolist()
+            except Exception as e:
+                for request in batch:
+                    request[3] = e
+                    request[1].set()
+                continue
+
+            for request, action in zip(batch, actions):
+                request[2] = action
+                request[1].set()
+
+
+class MCTSNode:
+    '''
+        Position of the search tree of MCTSAgent
+    * The statistics of the edges (actions) are seen by the player to move
+    '''
+    __slots__ = ('state', 'value', 'legal', 'priors', 'visits', 'values', 'children')
+
+    def __init__(self, state, value=None):
+        '''
+        - state : Raw state seen by the player to move
+        - value : Value for the parent's player if the game is finished, None otherwise
+        '''
+        self.state = state
+        self.value = value
+        # Set when the node is evaluated
+        self.legal = None
+        self.priors = None
+        # Visit counts and total values of the actions (including virtual losses)
+        self.visits = None
+        self.values = None
+        # Action -> MCTSNode
+        self.children = {}
+
+    def expand(self, legal, priors):
+        self.legal = legal
+        self.priors = priors
+        self.visits = T.zeros(len(priors))
+        self.values = T.zeros(len(priors))
+
+
+class MCTSAgent:
+    '''
+        Monte Carlo Tree Search (PUCT) guided by the Q values of an agent,
+    the priors are the softmax of the Q values and the value of a position
+    is its best Q value
+    * The leaves of batch_size simulations are evaluated with one forward
+    pass, virtual losses spread these simulations over the tree
+    * The subtree of the position reached is kept for the next move
+    '''
+    def __init__(self, agent, env, simulations=200, time_budget=None, batch_size=16,
+            c_puct=1.5, temperature=.1, virtual_loss=1.):
+        '''
+        - agent : QAgent, evaluates the positions (its state_preprocessor is used)
+        - env : Non batched environment of the games, copied to simulate moves
+        (see BoardEnv.set_state)
+        - simulations / time_budget : The search of a move stops after this number
+        of simulations or this time (s), None for no limit (not both)
+        - c_puct : Weight of the priors in the selection, higher values explore more
+        - temperature : Temperature of the softmax of the Q values (priors)
+        - virtual_loss : Loss added to the actions selected by pending simulations
+        '''
+        super().__init__()
+
+        if simulations is None and time_budget is None:
+            raise ValueError('MCTSAgent needs a number of simulations or a time budget')
+
+        self.agent = agent
+        self.env = copy.deepcopy(env)
+        self.simulations = simulations
+        self.time_budget = time_budget
+        self.batch_size = batch_size
+        self.c_puct = c_puct
+        self.temperature = temperature
+        self.virtual_loss = virtual_loss
+
+        self.root = None
+        # Simulations of the last search (backed up to the root)
+        self.last_simulations = 0
+
+    def reset(self):
+        '''
+            Forgets the tree, ie when the weights of agent change
+        '''
+        self.root = None
+
+    def act(self, state):
+        '''
+            Functor f(state) -> action, the most visited action after the search
+        * state is raw (not preprocessed)
+        '''
+        root = self.__find_root(state)
+        if root.priors is None:
+            self.__evaluate([(root, [])])
+
+        if self.time_budget is not None:
+            deadline = time.perf_counter() + self.time_budget
+        # Only the simulations backed up count, the ones reaching a pending leaf are dropped
+        # (the first one of a batch always counts)
+        start = root.visits.sum()
+        count = 0
+        while (self.simulations is None or count < self.simulations) and \
+                (self.time_budget is None or time.perf_counter() < deadline):
+            n = self.batch_size if self.simulations is None else min(self.batch_size, self.simulations - count)
+            leaves = []
+            for _ in range(n):
+                leaf = self.__select(root)
+                if leaf is not None:
+                    leaves.append(leaf)
+            self.__evaluate(leaves)
+            count = round(float(root.visits.sum() - start))
+
+        self.last_simulations = count
+
+        action = int(root.visits.masked_fill(~root.legal, -1).argmax())
+        self.root = root.children.get(action)
+
+        return action
+
+    def __find_root(self, state):
+        '''
+            Node of state, the subtree of the previous search is reused
+        if state follows the last move
+        '''
+        if self.root is not None:
+            if self.root.state.equal(state):
+                return self.root
+
+            # Moves of the opponent
+            for child in self.root.children.values():
+                if child.state.equal(state):
+                    return child
+
+        self.root = MCTSNode(state.clone())
+
+        return self.root
+
+    def __select(self, root):
+        '''
+            Descends the tree with virtual losses until a new position,
+        finished games are backed up immediately
+        - Returns (leaf, path) to evaluate or None
+        '''
+        node = root
+        path = []
+        while True:
+            n = node.visits
+            q = node.values / n.clamp(min=1)
+            u = self.c_puct * node.priors * (n.sum() + 1).sqrt() / (1 + n)
+            action = int((q + u).masked_fill(~node.legal, -float('inf')).argmax())
+
+            path.append((node, action))
+            n[action] += self.virtual_loss
+            node.values[action] -= self.virtual_loss
+
+            child = node.children.get(action)
+            if child is None:
+                break
+
+            if child.value is not None:
+                self.__backup(path, child.value)
+                return None
+
+            # Pending evaluation of another simulation
+            if child.priors is None:
+                self.__backup(path, None)
+                return None
+
+            node = child
+
+        # Moves of the path from the root
+        self.env.set_state(root.state)
+        for _, a in path:
+            state, reward, done, _ = self.env.step(a)
+
+        child = node.children[action] = MCTSNode(state.clone(), reward if done else None)
+        if done:
+            self.__backup(path, reward)
+            return None
+
+        return child, path
+
+    def __evaluate(self, leaves):
+        '''
+            Expands the leaves with one forward pass and backs up their values
+        '''
+        if len(leaves) == 0:
+            return
+
+        states = T.stack([leaf.state for leaf, _ in leaves])
+        legal = self.env.legal_actions(states)
+        q = self.agent.infer(self.agent.state_preprocessor(states))
+        q = q.view(len(leaves), -1).masked_fill(~legal, -float('inf'))
+
+        priors = F.softmax(q / self.temperature, 1)
+        values = q.max(1)[0].clamp(-1, 1).tolist()
+
+        for (leaf, path), l, p, v in zip(leaves, legal, priors, values):
+            leaf.expand(l, p)
+            if len(path) > 0:
+                # Zero sum, the value of the leaf's player is the opposite
+                self.__backup(path, -v)
+
+    def __backup(self, path, value):
+        '''
+            Removes the virtual losses of path and adds value (for the player
+        of the last node, None to only remove the losses)
+        '''
+        if value is None:
+            for node, action in path:
+                node.visits[action] -= self.virtual_loss
+                node.values[action] += self.virtual_loss
 
-        loss = F.mse_loss(q, q_target.detach()).mean()
-        # loss = F.smooth_l1_loss(q, q_target.detach()).mean()
+            return
 
-        return loss
+        for node, action in reversed(path):
+            node.visits[action] += 1 - self.virtual_loss
+            node.values[action] += value + self.virtual_loss
+            value = -value
@@ -0,0 +1,168 @@
+# Training checkpoints
+
+import os
+import queue
+import random as rand
+import threading
+import torch as T
+
+
+def rng_state():
+    '''
+        State of the random generators (python + pytorch)
+    '''
+    return {'python': rand.getstate(), 'torch': T.get_rng_state()}
+
+
+def set_rng_state(state):
+    '''
+        Restores the random generators from rng_state
+    '''
+    rand.setstate(state['python'])
+    T.set_rng_state(state['torch'])
+
+
+def snapshot(obj):
+    '''
+        Copies the tensors of nested dicts / lists / tuples,
+    other objects are not copied
+    '''
+    if isinstance(obj, T.Tensor):
+        return obj.detach().clone()
+    elif isinstance(obj, dict):
+        return {k: snapshot(v) for k, v in obj.items()}
+    elif isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(v) for v in obj)
+
+    return obj
+
+
+def load_weights(path):
+    '''
+        Weights of the dqn saved in path, either by QAgent.save or by
+    Checkpointer.save (see QAgent.dqn.load_state_dict)
+    '''
+    # Checkpoints contain python objects
+    state = T.load(path, weights_only=False)
+    if isinstance(state, dict) and 'agent' in state:
+        return state['agent']['dqn']
+
+    return state
+
+
+class Checkpointer:
+    '''
+        Saves the whole training state (agent, optimizer, memory, logger and
+    random generators) in a directory, only the last checkpoints are kept
+    * save copies the tensors, the files are written by a background thread
+    * Training resumed from a checkpoint is the same as without interruption
+    if checkpoints are saved between two calls of utils.train
+    '''
+    def __init__(self, directory, keep=3):
+        '''
+        - directory : Created if necessary
+        - keep : Number of checkpoints kept, the oldest ones are removed
+        '''
+        super().__init__()
+
+        self.directory = directory
+        self.keep = keep
+
+        os.makedirs(directory, exist_ok=True)
+
+        # At most one checkpoint waits to be written, None stops the writer
+        self.pending = queue.Queue(1)
+        self.thread = threading.Thread(target=self.__write, daemon=True)
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def path(self, step):
+        return os.path.join(self.directory, f'checkpoint_{step:09d}.pt')
+
+    def steps(self):
+        '''
+            Steps of the checkpoints in the directory, sorted
+        '''
+        return sorted(int(f[len('checkpoint_'):-len('.pt')]) for f in os.listdir(self.directory)
+                if f.startswith('checkpoint_') and f.endswith('.pt'))
+
+    def save(self, step, agent, mem=None, logger=None):
+        '''
+            Saves a checkpoint in background
+        - step : Progress of the training, ie number of games played
+        * Blocks if the previous checkpoint is still waiting to be written
+        '''
+        state = {
+            'step': step,
+            'agent': agent.state_dict(),
+            'mem': None if mem is None else mem.state_dict(),
+            'logger': None if logger is None else logger.state_dict(),
+            'rng': rng_state(),
+        }
+
+        self.pending.put(snapshot(state))
+
+    def __write(self):
+        '''
+            Writes the pending checkpoints (writer thread)
+        '''
+        while True:
+            state = self.pending.get()
+            if state is None:
+                self.pending.task_done()
+                break
+
+            # Written then renamed, a preemption never leaves a partial checkpoint
+            path = self.path(state['step'])
+            T.save(state, path + '.tmp')
+            os.replace(path + '.tmp', path)
+
+            for step in self.steps()[:-self.keep]:
+                os.remove(self.path(step))
+
+            self.pending.task_done()
+
+    def wait(self):
+        '''
+            Waits until all checkpoints are written
+        '''
+        self.pending.join()
+
+    def close(self):
+        '''
+            Writes the pending checkpoints and stops the writer thread
+        '''
+        if self.thread.is_alive():
+            self.pending.put(None)
+            self.thread.join()
+
+    def load(self, agent, mem=None, logger=None, step=None):
+        '''
+            Restores a checkpoint, the last one by default
+        - Returns the step of the checkpoint, 0 if there is no checkpoint
+        '''
+        self.wait()
+
+        steps = self.steps()
+        if step is None:
+            if len(steps) == 0:
+                return 0
+
+            step = steps[-1]
+
+        # Written by save, contains python objects
+        state = T.load(self.path(step), weights_only=False)
+
+        agent.load_state_dict(state['agent'])
+        if mem is not None:
+            mem.load_state_dict(state['mem'])
+        if logger is not None:
+            logger.load_state_dict(state['logger'])
+        set_rng_state(state['rng'])
+
+        return state['step']
@@ -1,7 +1,157 @@
 # All DQNs
 
+import copy
+import warnings
+import torch as T
 from torch import nn
 import torch.nn.functional as F
+from torch.ao import quantization
+from torch.ao.quantization import quantize_fx
+
+
+def compile_inference(net, example):
+    '''
+        Compiled copy of net for inference : TorchScript trace with frozen
+    weights, linear / conv + ReLU are fused when supported
+    - example : Input used to trace net, the batch size can change
+    but not the number of dimensions
+    !!! The weights are copied, it must be rebuilt when net learns
+    '''
+    training = net.training
+    net.eval()
+    # TorchScript is deprecated but torch.compile takes seconds and is slower at batch 1 on CPU
+    with T.no_grad(), warnings.catch_warnings():
+        warnings.simplefilter('ignore', FutureWarning)
+        traced = T.jit.trace(net, example, check_trace=False)
+        compiled = T.jit.optimize_for_inference(T.jit.freeze(traced))
+    net.train(training)
+
+    return compiled
+
+
+def quantize(net, calibration_states):
+    '''
+        Int8 copy of net for CPU inference, linear / conv layers (fused with
+    their ReLU) are statically quantized (see requantize_weights for new weights)
+    - calibration_states : Batch of inputs used to measure the ranges of the activations
+    '''
+    qconfig = quantization.get_default_qconfig_mapping('x86')
+
+    # The copy is only used to build the graph, the float weights are dropped by convert_fx
+    net = copy.deepcopy(net).eval()
+    # torch.ao.quantization is deprecated but still the only int8 path without torchao
+    with T.no_grad(), warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        prepared = quantize_fx.prepare_fx(net, qconfig, (calibration_states,))
+        prepared(calibration_states)
+
+        return quantize_fx.convert_fx(prepared)
+
+
+def requantize_weights(quantized, net):
+    '''
+        Loads the weights of net in quantized (see quantize), the ranges
+    of the activations are kept (no calibration)
+    '''
+    modules = dict(net.named_modules())
+    observer = quantization.get_default_qconfig('x86').weight
+
+    with T.no_grad():
+        for name, module in quantized.named_modules():
+            if not hasattr(module, 'set_weight_bias') or name not in modules:
+                continue
+
+            weight = modules[name].weight.detach()
+            obs = observer()
+            obs(weight)
+            scale, zero_point = obs.calculate_qparams()
+            if obs.qscheme in (T.per_channel_symmetric, T.per_channel_affine):
+                weight = T.quantize_per_channel(weight, scale.to(T.float64), zero_point, obs.ch_axis, obs.dtype)
+            else:
+                weight = T.quantize_per_tensor(weight, float(scale), int(zero_point), obs.dtype)
+
+            bias = modules[name].bias
+            module.set_weight_bias(weight, None if bias is None else bias.detach().clone())
+
+
+class QuantizedDQN:
+    '''
+        Int8 copy of a dqn for actors (see quantize), only for inference
+    * refresh updates the copy with the current weights of the dqn,
+    calibrate measures the ranges of the activations again
+    * The ranges drift with the weights, every check_freq refreshes the
+    agreement is measured and the copy is calibrated again if it dropped
+    '''
+    def __init__(self, net, calibration_states, check_freq=10, tolerance=.05):
+        '''
+        - net : Float dqn, not copied (the int8 copy follows its weights)
+        - calibration_states : Batch of inputs used to calibrate the activations
+        - check_freq : Refreshes between two parity checks (see agreement), 0 disables them
+        - tolerance : Drop of the agreement since the last calibration that triggers
+        a new calibration
+        '''
+        super().__init__()
+
+        self.float_net = net
+        self.calibration_states = calibration_states
+        self.check_freq = check_freq
+        self.tolerance = tolerance
+        self.calibrate()
+
+    def __call__(self, states):
+        '''
+            Q values of a batch of states, or of a single state
+        '''
+        with T.inference_mode():
+            if states.dim() < self.calibration_states.dim():
+                return self.net(states.unsqueeze(0))[0]
+
+            return self.net(states)
+
+    def calibrate(self):
+        '''
+            Quantizes the dqn from scratch (~100x slower than refresh)
+        '''
+        self.quantized = quantize(self.float_net, self.calibration_states)
+
+        # The quantize / dequantize overhead of eager mode is larger than the int8 speedup,
+        # not frozen so that refresh can replace the weights (as fast as frozen)
+        with T.no_grad(), warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            self.net = T.jit.trace(self.quantized, self.calibration_states[:1], check_trace=False).eval()
+
+        # Reference of the parity checks of refresh
+        self.calibrated_agreement = self.agreement()
+        self.refreshes = 0
+
+    def refresh(self):
+        '''
+            Quantizes the current weights of the dqn (~5 ms), the activations
+        keep the ranges of the last calibration unless the agreement dropped
+        '''
+        requantize_weights(self.quantized, self.float_net)
+
+        # The traced modules have their own copies of the packed weights
+        for name, module in self.quantized.named_modules():
+            packed = getattr(module, '_packed_params', None)
+            if packed is not None and not isinstance(packed, nn.Module):
+                setattr(self.net.get_submodule(name), '_packed_params', packed)
+
+        self.refreshes += 1
+        if self.check_freq > 0 and self.refreshes % self.check_freq == 0 and \
+                self.agreement() < self.calibrated_agreement - self.tolerance:
+            self.calibrate()
+
+    def agreement(self, states=None):
+        '''
+            Parity check, rate of states where the float and int8 dqns
+        choose the same action (calibration states by default)
+        '''
+        if states is None:
+            states = self.calibration_states
+
+        with T.no_grad():
+            return (self(states).argmax(-1) == self.float_net(states).argmax(-1)).float().mean().item()
 
 
 class MLP(nn.Module):
@@ -112,8 +262,46 @@ class Conn(nn.Module):
 
     def forward(self, state):
         state = self.convolve(state)
-        state = state.view(-1, self.flatten_size)
+        # Quantized convolutions return channels last tensors
+        state = state.reshape(-1, self.flatten_size)
         state = self.connect(state)
 
         return state
 
+
+
+class BoardConn(nn.Module):
+    '''
+        Fully convolutional network, works with any board size
+    * Q values of cells (x * height + y) or of columns (gravity)
+    * Can be represented as :
+    ReLU(Conv(channels[i - 1], channels[i], kernel)) -> Conv(channels[-1], 1, 1)
+    '''
+    def __init__(self, depth, channels=[64, 64, 64], kernel=3, gravity=False):
+        '''
+        - depth : Number of channels of the state (one hot depth)
+        - channels : Int list, describes hidden layers
+        - kernel : Odd size of the convolutions, padded to keep the board size
+        - gravity : If True, Q values of columns (actions of envs.ConnectN),
+        the features of each column are averaged before the last layer
+        '''
+        super().__init__()
+
+        self.gravity = gravity
+
+        layers = []
+        for n_in, n_out in zip([depth] + channels[:-1], channels):
+            layers.append(nn.Conv2d(n_in, n_out, kernel, padding=kernel // 2))
+            layers.append(nn.ReLU())
+        self.convolve = nn.Sequential(*layers)
+
+        self.head = nn.Conv2d(channels[-1], 1, 1)
+
+    def forward(self, state):
+        state = self.convolve(state)
+        if self.gravity:
+            # [batch, channels, x, 1]
+            state = state.mean(-1, keepdim=True)
+
+        # Works with single states too
+        return self.head(state).flatten(-3)
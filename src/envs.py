@@ -1,15 +1,100 @@
 # Environments
 
 import random as rand
+import time
 import torch as T
+import torch.nn.functional as F
 from log import as_red, as_blue, as_green
 
 
+def grid_symmetries(width, height, rotations=True, flip_y=False):
+    '''
+        Cell permutations of the symmetries of a width x height grid,
+    the cell [x, y] has index x * height + y
+    - rotations : If True, all 8 symmetries of a square grid (D4 group),
+    otherwise the identity and the mirror along x
+    - flip_y : Without rotations, adds the mirror along y and the 180° rotation,
+    all 4 symmetries of a rectangular grid (not valid with gravity)
+    - Returns [n_symmetries, width * height], the first symmetry is the identity
+    * A state is transformed with state.flatten()[permutation]
+    '''
+    grid = T.arange(width * height).view(width, height)
+    if not rotations:
+        grids = [grid, grid.flip(0)] + ([grid.flip(1), grid.flip(0).flip(1)] if flip_y else [])
+
+        return T.stack([g.flatten() for g in grids])
+
+    return T.stack([g.rot90(k).flatten() for g in (grid, grid.flip(0)) for k in range(4)])
+
+
+def canonical_states(states, cell_symmetries):
+    '''
+        Canonical forms of a batch of raw states, the smallest symmetric
+    state in lexicographic order
+    - cell_symmetries : Cell permutations of the symmetries (see grid_symmetries)
+    - Returns canonical states, index of the symmetry applied to each state
+    '''
+    # [batch, symmetry, cell]
+    variants = states.flatten(1)[:, cell_symmetries]
+    best = variants[:, 0]
+    sym = T.zeros([len(states)], dtype=T.long)
+
+    for i in range(1, len(cell_symmetries)):
+        # The first different cell decides
+        diff = variants[:, i] - best
+        first = (diff != 0).long().argmax(1, keepdim=True)
+        smaller = diff.gather(1, first).squeeze(1) < 0
+
+        best = T.where(smaller.unsqueeze(1), variants[:, i], best)
+        sym[smaller] = i
+
+    return best.view(states.shape), sym
+
+
+def canonical_transitions(actions, states, next_states, cell_symmetries, action_symmetries):
+    '''
+        Moves a batch of transitions to canonical states, the action
+    follows the symmetry of the state
+    - action_symmetries : [n_symmetries, n_action] Image of each action by each symmetry
+    - Returns actions, states, next_states
+    * next_states are canonical too, the max of their Q values doesn't
+    depend on the symmetry
+    '''
+    states, sym = canonical_states(states, cell_symmetries)
+
+    return action_symmetries[sym, actions], states, canonical_states(next_states, cell_symmetries)[0]
+
+
+def augment_transitions(actions, states, next_states, rewards, dones, cell_symmetries, action_symmetries):
+    '''
+        Expands a batch of transitions with all their symmetric copies
+    - Returns actions, states, next_states, rewards, dones of size
+    n_symmetries * batch, the first batch is the original one
+    '''
+    n = len(cell_symmetries)
+
+    def expand(x):
+        return x.flatten(1)[:, cell_symmetries].transpose(0, 1).reshape(-1, *x.shape[1:])
+
+    return action_symmetries[:, actions].flatten(), expand(states), expand(next_states), \
+            rewards.repeat(n), dones.repeat(n)
+
+
 class BoardEnv:
     '''
         Abstract class for all environments
     * Each environment has two players
     '''
+    # Whether the environment plays several games at once (see BoardEnvVec)
+    batched = False
+    # Seed of the Zobrist keys, hashes are the same for all runs
+    ZOBRIST_SEED = 161831415
+    # [n_symmetries, n_cells] Cell permutations of the symmetries of the board
+    # (see grid_symmetries), None if the environment has no symmetries
+    CELL_SYMMETRIES = None
+    # [n_symmetries, n_action] Image of each action by each symmetry
+    ACTION_SYMMETRIES = None
+
     def __init__(self, n_state, n_action):
         '''
         - n_state : Dimension of the observation space
@@ -18,6 +103,11 @@ class BoardEnv:
         self.n_state = n_state
         self.n_action = n_action
 
+        # Zobrist keys [cell][player 1 chip, player 2 chip]
+        n_cells = n_state if isinstance(n_state, int) else n_state[0] * n_state[1]
+        keys = rand.Random(BoardEnv.ZOBRIST_SEED)
+        self.zobrist = [(keys.getrandbits(64), keys.getrandbits(64)) for _ in range(n_cells)]
+
         self.reset()
 
     def __repr__(self):
@@ -35,6 +125,85 @@ class BoardEnv:
         self.p1_turn = rand.randint(0, 1) == 0
         self.was_draw = False
 
+        # Zobrist hashes of the state and of p2_state, updated with update_hash
+        self.hash = 0
+        self.p2_hash = 0
+        # Hash of the last returned state
+        self.obs_hash = 0
+
+    def set_state(self, state):
+        '''
+            Continues a game from state, seen by the player to move (its chips
+        are -1, see step), this player becomes player 1, ie to simulate moves
+        - Returns state, p1_turn
+        '''
+        self.reset()
+
+        # The chips of player 1 are 1
+        board = -state
+        self.load_board(board)
+        self.p1_turn = True
+
+        cells = board.flatten()
+        self.turns = int((cells != 0).sum())
+        for cell in cells.nonzero()[:, 0].tolist():
+            self.update_hash(cell, int(cells[cell]))
+        self.obs_hash = self.p2_hash
+
+        return self.p2_state(), self.p1_turn
+
+    def load_board(self, board):
+        '''
+            Sets the chips of a reset game, board is the state for player 1
+        * Used by set_state
+        '''
+        raise NotImplementedError()
+
+    def update_hash(self, cell, player_id):
+        '''
+            Updates the hashes when the chip player_id (1 or -1) is placed
+        at cell (index within the flattened state)
+        '''
+        self.hash ^= self.zobrist[cell][player_id < 0]
+        self.p2_hash ^= self.zobrist[cell][player_id > 0]
+
+    @classmethod
+    def legal_actions(cls, states):
+        '''
+            Masks of the legal actions of raw states (works with batches of states)
+        - Returns BoolTensor [..., n_action]
+        '''
+        raise NotImplementedError()
+
+    def legal_mask(self):
+        '''
+            Mask of the legal actions of the current state ([n_envs, n_action]
+        for batched environments)
+        '''
+        return self.legal_actions(self.state)
+
+    @classmethod
+    def canonical(cls, states):
+        '''
+            Canonical forms of a batch of raw states (see canonical_states)
+        '''
+        return canonical_states(states, cls.CELL_SYMMETRIES)
+
+    @classmethod
+    def canonical_transitions(cls, actions, states, next_states):
+        '''
+            Moves a batch of transitions to canonical states (see canonical_transitions)
+        '''
+        return canonical_transitions(actions, states, next_states, cls.CELL_SYMMETRIES, cls.ACTION_SYMMETRIES)
+
+    @classmethod
+    def augment(cls, actions, states, next_states, rewards, dones):
+        '''
+            Expands a batch of transitions with their symmetric copies (see augment_transitions)
+        '''
+        return augment_transitions(actions, states, next_states, rewards, dones,
+                cls.CELL_SYMMETRIES, cls.ACTION_SYMMETRIES)
+
     def to_str(self):
         '''
             Returns the string representation of the environment
@@ -63,18 +232,100 @@ class BoardEnv:
         # Change turn
         self.p1_turn = not self.p1_turn
 
+        self.obs_hash = self.hash if turn else self.p2_hash
+
         return (self.state if turn else self.p2_state()), reward, done, self.p1_turn
 
     def render(self):
         print(str(self))
 
 
+class BoardEnvVec(BoardEnv):
+    '''
+        Abstract class for environments playing n_envs games at once
+    * All attributes of BoardEnv are tensors with a first dimension of n_envs
+    * Finished games are reset automatically after each step
+    '''
+    batched = True
+    # Shape of one board
+    SHAPE = None
+
+    def __init__(self, n_envs, n_state, n_action):
+        '''
+        - n_envs : Number of games played in parallel
+        '''
+        self.n_envs = n_envs
+
+        super().__init__(n_state, n_action)
+
+    def __repr__(self):
+        return self.to_str()
+
+    def reset(self):
+        '''
+            Resets all games
+        - Returns obs, p1_turn
+        '''
+        super().reset()
+
+        self.state = T.zeros([self.n_envs, *self.SHAPE], dtype=T.long)
+        self.turns = T.zeros([self.n_envs], dtype=T.long)
+        self.p1_turn = T.randint(0, 2, [self.n_envs]) == 0
+        self.was_draw = T.zeros([self.n_envs], dtype=T.bool)
+        # State seen by the player to move
+        self.obs = T.zeros_like(self.state)
+
+        return self.obs, self.p1_turn
+
+    def reset_games(self, mask):
+        '''
+            Resets the games selected by the BoolTensor mask
+        '''
+        n = int(mask.sum())
+        self.state[mask] = 0
+        self.obs[mask] = 0
+        self.turns[mask] = 0
+        self.p1_turn[mask] = T.randint(0, 2, [n]) == 0
+
+    def p2_state(self):
+        return -self.state
+
+    def step(self, action):
+        '''
+            Action is a LongTensor of shape [n_envs]
+        - Returns state, reward, done, p1_turn (batched)
+        * The returned states are the states before the automatic reset
+        (last states of finished games), the next player has to use self.obs
+        '''
+        # Current turn
+        turn = self.p1_turn
+        self.turns += 1
+
+        # Play turn
+        reward, done = self.play_turn(action)
+
+        # Change turn
+        self.p1_turn = ~self.p1_turn
+
+        # Same as BoardEnv but for each game
+        state = T.where(turn.view(-1, *[1] * len(self.SHAPE)), self.state, self.p2_state())
+        self.obs = state.clone()
+
+        if done.any():
+            self.reset_games(done)
+
+        return state, reward, done, self.p1_turn
+
+
 class TicTacToe(BoardEnv):
     REWARD_WIN = 1
     REWARD_LOOSE = -1
     REWARD_DRAW = -.1
     REWARD_NONE = 0
     REWARD_INVALID_ACTION = -10
+    # The actions are cells
+    CELL_SYMMETRIES = grid_symmetries(3, 3)
+    ACTION_SYMMETRIES = CELL_SYMMETRIES.argsort(1)
 
     def __init__(self):
         super().__init__(n_state=9, n_action=9)
@@ -93,6 +344,7 @@ class TicTacToe(BoardEnv):
 
         # Update state
         self.state[action] = player_id
+        self.update_hash(action, player_id)
 
         # Check diagonals
         if self.state[4] != 0:
@@ -132,7 +384,16 @@ class TicTacToe(BoardEnv):
 
         return self.state, self.p1_turn
 
-    def to_str(self):
+    def load_board(self, board):
+        self.state = board.clone()
+
+    def to_str(self, state=None):
+        '''
+        - state : Board to display, the current one by default
+        '''
+        if state is None:
+            state = self.state
+
         s = '-------\n'
 
         def digit_symbol(c, i):
@@ -150,7 +411,7 @@ class TicTacToe(BoardEnv):
             s += '|'
             for x in range(3):
                 # Symbol
-                s += digit_symbol(self.state[x + y * 3], x + y * 3)
+                s += digit_symbol(state[x + y * 3], x + y * 3)
                 # Column
                 s += '|'
             s += '\n'
@@ -158,21 +419,191 @@ class TicTacToe(BoardEnv):
 
         return s
 
+    @classmethod
+    def legal_actions(cls, states):
+        return states == 0
+
     @classmethod
     def random_act(cls):
         '''
             Creates a functor that takes valid random actions for this env
         '''
         def act(state):
-            a = rand.randint(0, 8)
-            while state[a] != 0:
-                a = rand.randint(0, 8)
+            return rand.choice(cls.legal_actions(state).nonzero()[:, 0].tolist())
 
-            return a
+        return act
+
+    @classmethod
+    def perfect_act(cls):
+        '''
+            Creates a functor that plays optimal actions (see TicTacToeTable)
+        '''
+        return TicTacToeTable.get().act
+
+
+class TicTacToeVec(BoardEnvVec):
+    '''
+        n_envs games of Tic Tac Toe played with tensor operations only
+    '''
+    REWARD_WIN = TicTacToe.REWARD_WIN
+    REWARD_LOOSE = TicTacToe.REWARD_LOOSE
+    REWARD_DRAW = TicTacToe.REWARD_DRAW
+    REWARD_NONE = TicTacToe.REWARD_NONE
+    REWARD_INVALID_ACTION = TicTacToe.REWARD_INVALID_ACTION
+    CELL_SYMMETRIES = TicTacToe.CELL_SYMMETRIES
+    ACTION_SYMMETRIES = TicTacToe.ACTION_SYMMETRIES
+    SHAPE = [9]
+    # The 8 winning lines (3 rows, 3 columns, 2 diagonals)
+    LINES = T.tensor([
+        [0, 1, 2], [3, 4, 5], [6, 7, 8],
+        [0, 3, 6], [1, 4, 7], [2, 5, 8],
+        [0, 4, 8], [2, 4, 6],
+    ])
+
+    def __init__(self, n_envs):
+        super().__init__(n_envs, n_state=9, n_action=9)
+
+    def play_turn(self, action):
+        '''
+        - Returns reward, done (batched)
+        * action is supposed within 0 and 8 included
+        '''
+        games = T.arange(self.n_envs)
+        cell = self.state[games, action]
+        invalid = cell != 0
+
+        # The value which represents current player's chip
+        player_id = T.where(self.p1_turn, 1, -1)
+
+        # Update state
+        self.state[games, action] = T.where(invalid, cell, player_id)
+
+        # Only the current player can complete a line
+        win = (self.state[:, TicTacToeVec.LINES].sum(2) == 3 * player_id.unsqueeze(1)).any(1) & ~invalid
+        draw = ~win & ~invalid & (self.turns >= 9)
+        self.was_draw = draw
+
+        reward = T.full([self.n_envs], float(TicTacToeVec.REWARD_NONE))
+        reward[win] = TicTacToeVec.REWARD_WIN
+        reward[draw] = TicTacToeVec.REWARD_DRAW
+        reward[invalid] = TicTacToeVec.REWARD_INVALID_ACTION
+
+        return reward, invalid | win | draw
+
+    def to_str(self):
+        s = []
+        for i in range(self.n_envs):
+            s.append(as_green('P1' if self.p1_turn[i] else 'P2'))
+            s.append(TicTacToe.to_str(self, self.state[i]))
+
+        return '\n'.join(s)
+
+    @classmethod
+    def legal_actions(cls, states):
+        return states == 0
+
+    @classmethod
+    def random_act(cls):
+        '''
+            Creates a functor that takes valid random actions for
+        a batch of states
+        '''
+        def act(state):
+            return T.multinomial(cls.legal_actions(state).to(T.float32), 1).squeeze(1)
 
         return act
 
 
+class TicTacToeTable:
+    '''
+        Solved Tic Tac Toe, built once by retrograde analysis
+    * Positions are seen by the player to move (its chips are -1, as in the
+    states returned by step), their id is sum((state[i] % 3) * 3 ** i)
+    * values[id] is 1 if the player to move wins, 0 for draws and -1 for defeats,
+    moves[id] is the bit mask of the optimal actions
+    '''
+    N_IDS = 3 ** 9
+    POWERS = 3 ** T.arange(9)
+    __table = None
+
+    def __init__(self):
+        ids = T.arange(TicTacToeTable.N_IDS)
+        # [id, cell] within -1, 0, 1
+        cells = ids.unsqueeze(1) // TicTacToeTable.POWERS % 3
+        cells[cells == 2] = -1
+        chips = (cells == -1).sum(1), (cells == 1).sum(1)
+        lines = cells[:, TicTacToeVec.LINES]
+
+        # Id of the position seen by the other player
+        self.opposite = self.id(-cells)
+        # Positions where the game is not finished
+        self.reachable = ((chips[0] == chips[1]) | (chips[0] == chips[1] - 1)) & \
+                (lines.sum(2).abs() != 3).all(1) & (chips[0] + chips[1] < 9)
+
+        self.values = T.zeros([TicTacToeTable.N_IDS], dtype=T.int8)
+        self.moves = T.zeros([TicTacToeTable.N_IDS], dtype=T.int16)
+
+        # From the last moves, the positions after a move are already solved
+        for n in range(8, -1, -1):
+            idx = (self.reachable & (chips[0] + chips[1] == n)).nonzero().squeeze(1)
+            empty = cells[idx] == 0
+
+            # [position, action, cell], state after each action
+            next_cells = cells[idx].unsqueeze(1) - T.eye(9, dtype=T.long)
+            next_ids = T.where(empty, idx.unsqueeze(1) + 2 * TicTacToeTable.POWERS, 0)
+            won = (next_cells[:, :, TicTacToeVec.LINES] == -1).all(3).any(2)
+
+            if n == 8:
+                value = T.where(won, 1, 0)
+            else:
+                value = T.where(won, 1, -self.values[self.opposite[next_ids]].long())
+            value[~empty] = -2
+
+            best = value.max(1)[0]
+            self.values[idx] = best.to(T.int8)
+            self.moves[idx] = ((value == best.unsqueeze(1)).long() << T.arange(9)).sum(1).to(T.int16)
+
+    @classmethod
+    def get(cls):
+        '''
+            The table, solved at the first call
+        '''
+        if cls.__table is None:
+            cls.__table = cls()
+
+        return cls.__table
+
+    @staticmethod
+    def id(state):
+        '''
+            Ids of states (works with batches of states)
+        '''
+        return (state % 3 * TicTacToeTable.POWERS).sum(-1)
+
+    def act(self, state):
+        '''
+            Functor f(state) -> action, plays a random optimal action
+        '''
+        moves = self.moves[self.id(state)].item()
+
+        return rand.choice([a for a in range(9) if moves >> a & 1])
+
+    def score(self, act_batch, state_preprocessor=lambda x: x):
+        '''
+            Ratio of reachable positions where act_batch plays an optimal action
+        - act_batch : Functor f(states) -> actions, takes a batch of all
+        positions at once (QAgent.act_batch with an exploration rate of 0)
+        '''
+        idx = self.reachable.nonzero().squeeze(1)
+        states = idx.unsqueeze(1) // TicTacToeTable.POWERS % 3
+        states[states == 2] = -1
+
+        actions = act_batch(state_preprocessor(states))
+        optimal = (self.moves[idx].long() >> actions) & 1
+
+        return optimal.float().mean().item()
+
+
 class Connect4(BoardEnv):
     REWARD_WIN = 1
     REWARD_LOOSE = -1
@@ -181,64 +612,69 @@ class Connect4(BoardEnv):
     REWARD_INVALID_ACTION = -10
     WIDTH = 7
     HEIGHT = 6
+    # Bitboard layout : column x uses bits [x * (HEIGHT + 1), (x + 1) * (HEIGHT + 1)),
+    # the lowest bit is the bottom of the column and the last one is always empty
+    COL_BITS = HEIGHT + 1
+    # Shifts to the next cell of a line (vertical, horizontal and both diagonals)
+    LINE_SHIFTS = (1, COL_BITS, COL_BITS - 1, COL_BITS + 1)
+    # Bit of the cell [x, y] (y = 0 is the top of the board)
+    CELL_BITS = T.arange(WIDTH).unsqueeze(1) * COL_BITS + HEIGHT - 1 - T.arange(HEIGHT)
+    # Left-right mirror, the actions are columns
+    CELL_SYMMETRIES = grid_symmetries(WIDTH, HEIGHT, rotations=False)
+    ACTION_SYMMETRIES = T.stack([T.arange(WIDTH), T.arange(WIDTH).flip(0)])
 
     def __init__(self):
         super().__init__(n_state=[Connect4.HEIGHT, Connect4.WIDTH], n_action=Connect4.WIDTH)
 
-    def __winner(self):
+    @property
+    def state(self):
         '''
-            Wether there is a winner
+            State for player 1, [x, y] LongTensor
+        * Built from the bitboards only when it is read
         '''
-        # Diags
-        for x in range(Connect4.WIDTH - 3):
-            for y in range(Connect4.HEIGHT - 3):
-                if self.state[x, y] == self.state[x + 1, y + 1] == self.state[x + 2, y + 2] == self.state[x + 3, y + 3] != 0:
-                    return True
-
-                if self.state[x + 3, y] == self.state[x + 2, y + 1] == self.state[x + 1, y + 2] == self.state[x, y + 3] != 0:
-                    return True
+        if self.__state is None:
+            p1 = T.tensor(self.masks[0])
+            p2 = T.tensor(self.masks[1])
+            self.__state = ((p1 >> Connect4.CELL_BITS) & 1) - ((p2 >> Connect4.CELL_BITS) & 1)
 
-        # Rows
-        for x in range(Connect4.WIDTH - 3):
-            for y in range(Connect4.HEIGHT):
-                if self.state[x, y] == self.state[x + 1, y] == self.state[x + 2, y] == self.state[x + 3, y] != 0:
-                    return True
+        return self.__state
 
-        # Cols
-        for x in range(Connect4.WIDTH):
-            for y in range(Connect4.HEIGHT - 3):
-                if self.state[x, y] == self.state[x, y + 1] == self.state[x, y + 2] == self.state[x, y + 3] != 0:
-                    return True
+    @staticmethod
+    def is_winning(mask):
+        '''
+            Whether the bitboard mask contains 4 aligned chips
+        '''
+        for shift in Connect4.LINE_SHIFTS:
+            m = mask & (mask >> shift)
+            if m & (m >> 2 * shift):
+                return True
 
         return False
 
     def play_turn(self, action):
         '''
         - Returns reward, done
-        * action is supposed within 0 and 8 included
+        * action is supposed within 0 and 6 included
         '''
-        pos = -1
-
-        # Get the position of the chip
-        for y in range(Connect4.HEIGHT - 1, -1, -1):
-            if self.state[action, y] == 0:
-                pos = y
-                break
-
         # Invalid action
-        if pos == -1:
+        if self.heights[action] >= Connect4.HEIGHT:
             return Connect4.REWARD_INVALID_ACTION, True
 
-        # The value which represents current player's chip
-        player_id = 1 if self.p1_turn else -1
+        # Mask of the current player
+        player = 0 if self.p1_turn else 1
 
         # Update state
-        self.state[action, pos] = player_id
+        self.masks[player] |= 1 << (action * Connect4.COL_BITS + self.heights[action])
+        self.update_hash(action * Connect4.HEIGHT + Connect4.HEIGHT - 1 - self.heights[action], 1 - 2 * player)
+        self.heights[action] += 1
+        self.__state = None
 
-        if self.__winner():
+        # Only the current player can have a new line
+        if Connect4.is_winning(self.masks[player]):
             return Connect4.REWARD_WIN, True
 
         if self.turns >= Connect4.WIDTH * Connect4.HEIGHT:
+            self.was_draw = True
             return Connect4.REWARD_DRAW, True
 
         # Not a game end
@@ -251,14 +687,28 @@ class Connect4(BoardEnv):
         '''
         super().reset()
 
-        # State for player 1
-        # [x, y]
-        self.state = T.zeros([Connect4.WIDTH, Connect4.HEIGHT], dtype=T.long)
+        # Bitboards of player 1 and 2
+        self.masks = [0, 0]
+        # Number of chips within each column
+        self.heights = [0] * Connect4.WIDTH
+        self.__state = None
         self.turns = 0
 
         return self.state, self.p1_turn
 
-    def to_str(self):
+    def load_board(self, board):
+        self.masks = [int(((board == 1).long() << Connect4.CELL_BITS).sum()),
+                int(((board == -1).long() << Connect4.CELL_BITS).sum())]
+        self.heights = (board != 0).sum(1).tolist()
+        self.__state = None
+
+    def to_str(self, state=None):
+        '''
+        - state : Board to display, the current one by default
+        '''
+        if state is None:
+            state = self.state
+
         sep = '--' + '---' * Connect4.WIDTH
         s = sep + '\n'
 
@@ -277,7 +727,7 @@ class Connect4(BoardEnv):
             s += '|'
             for x in range(Connect4.WIDTH):
                 # Symbol
-                s += symbol(self.state[x][y], x, y)
+                s += symbol(state[x][y], x, y)
                 # Column
                 s += '|'
             s += '\n'
@@ -286,17 +736,22 @@ class Connect4(BoardEnv):
 
         return s
 
+    @classmethod
+    def legal_actions(cls, states):
+        # The top of the column is empty
+        return states[..., 0] == 0
+
+    def legal_mask(self):
+        # Without building the state
+        return T.tensor(self.heights) < Connect4.HEIGHT
+
     @classmethod
     def random_act(cls):
         '''
             Creates a functor that takes valid random actions for this env
         '''
         def act(state):
-            a = rand.randint(0, 6)
-            while state[a, 0] != 0:
-                a = rand.randint(0, 6)
-
-            return a
+            return rand.choice(cls.legal_actions(state).nonzero()[:, 0].tolist())
 
         return act
 
@@ -324,3 +779,521 @@ class Connect4(BoardEnv):
 
         return act
 
+    @classmethod
+    def search_act(cls, time_budget=.05, max_depth=WIDTH * HEIGHT, table_size=2 ** 20):
+        '''
+            Creates a functor that plays the best move found by an alpha-beta
+        search (see Connect4Search)
+        '''
+        return Connect4Search(time_budget, max_depth, table_size).act
+
+
+class Connect4Search:
+    '''
+        Negamax alpha-beta search on Connect4 bitboards with iterative deepening,
+    center first move ordering and a fixed size transposition table
+    * Scores are positive when the player to move wins, the faster the higher,
+    unfinished positions are evaluated by the difference of winning cells
+    '''
+    WIDTH = Connect4.WIDTH
+    HEIGHT = Connect4.HEIGHT
+    COL_BITS = Connect4.COL_BITS
+    N_CELLS = WIDTH * HEIGHT
+    # Center first, ORDERS[x] tries x first
+    ORDER = (3, 2, 4, 1, 5, 0, 6)
+    ORDERS = [(x,) + tuple(y for y in order if y != x) for order in [ORDER] for x in range(Connect4.WIDTH)]
+    BOTTOM = sum(1 << (x * Connect4.COL_BITS) for x in range(WIDTH))
+    BOARD = BOTTOM * ((1 << HEIGHT) - 1)
+    COLUMNS = [((1 << Connect4.HEIGHT) - 1) << (x * Connect4.COL_BITS) for x in range(WIDTH)]
+    # Bit of each cell of the flattened [x, y] state
+    CELL_BITS = [1 << b for b in Connect4.CELL_BITS.flatten().tolist()]
+    # Nodes between two clock checks
+    CLOCK_NODES = 1024
+    # Transposition table flags
+    EXACT, LOWER, UPPER = 0, 1, 2
+
+    class Timeout(Exception):
+        pass
+
+    def __init__(self, time_budget=.05, max_depth=N_CELLS, table_size=2 ** 20):
+        '''
+        - time_budget : Time (s) per move, the deepest finished iteration is played
+        - max_depth : Maximum depth (moves) of the search
+        - table_size : Number of entries of the transposition table
+        '''
+        super().__init__()
+
+        self.time_budget = time_budget
+        self.max_depth = max_depth
+        self.table_size = table_size
+        # Entries : (key, depth, flag, score, move)
+        self.table = [None] * table_size
+        self.nodes = 0
+        self.deadline = 0
+
+    @staticmethod
+    def winning_cells(position, mask, board=BOARD):
+        '''
+            Empty cells completing a line of position
+        * Unrolled for COL_BITS = 7, this is the hot spot of the search
+        * board is bound at definition, a local is faster than the class attribute
+        '''
+        # Vertical
+        r = (position << 1) & (position << 2) & (position << 3)
+
+        # Horizontal then both diagonals, 3 chips after / before the cell or
+        # 2 after and 1 before / 1 after and 2 before (shifts reused)
+        a1 = position << 7
+        a2 = a1 << 7
+        b1 = position >> 7
+        b2 = b1 >> 7
+        r |= (a1 & a2 & ((a2 << 7) | b1)) | (b1 & b2 & (a1 | (b2 >> 7)))
+
+        a1 = position << 6
+        a2 = a1 << 6
+        b1 = position >> 6
+        b2 = b1 >> 6
+        r |= (a1 & a2 & ((a2 << 6) | b1)) | (b1 & b2 & (a1 | (b2 >> 6)))
+
+        a1 = position << 8
+        a2 = a1 << 8
+        b1 = position >> 8
+        b2 = b1 >> 8
+        r |= (a1 & a2 & ((a2 << 8) | b1)) | (b1 & b2 & (a1 | (b2 >> 8)))
+
+        return r & (board ^ mask)
+
+    def act(self, state):
+        '''
+            Functor f(state) -> action
+        * The chips of the player to move are -1 (as in the states returned by step)
+        '''
+        position = 0
+        mask = 0
+        for bit, c in zip(Connect4Search.CELL_BITS, state.flatten().tolist()):
+            if c != 0:
+                mask |= bit
+                if c == -1:
+                    position |= bit
+
+        return self.search(position, mask)
+
+    def search(self, position, mask):
+        '''
+            Iterative deepening until the time budget is elapsed
+        - position : Bitboard of the player to move
+        - mask : Bitboard of all chips
+        - Returns the best column
+        '''
+        self.nodes = 0
+        self.deadline = time.perf_counter() + self.time_budget
+        moves = mask.bit_count()
+
+        possible = (mask + Connect4Search.BOTTOM) & Connect4Search.BOARD
+        legal = [x for x in Connect4Search.ORDER if possible & Connect4Search.COLUMNS[x]]
+        if not legal:
+            return 0
+
+        # Wins now or blocks the only threat
+        for cells in (Connect4Search.winning_cells(position, mask), Connect4Search.winning_cells(position ^ mask, mask)):
+            for x in legal:
+                if possible & cells & Connect4Search.COLUMNS[x]:
+                    return x
+
+        best = legal[0]
+        for depth in range(1, min(self.max_depth, Connect4Search.N_CELLS - moves) + 1):
+            try:
+                score = self.negamax(position, mask, moves, depth, -Connect4Search.N_CELLS, Connect4Search.N_CELLS)
+            except Connect4Search.Timeout:
+                break
+
+            entry = self.table[(position + mask) % self.table_size]
+            if entry is not None and entry[0] == position + mask and entry[4] is not None:
+                best = entry[4]
+
+            # Proven win or loss
+            if abs(score) >= 1:
+                break
+
+        return best
+
+    def negamax(self, position, mask, moves, depth, alpha, beta, wins=None):
+        '''
+            Score of the position for the player to move
+        - wins : winning_cells(position, mask) if known, the threats of the parent
+        without the played cell (they only depend on mask through its empty cells)
+        * Raises Timeout when the time budget is elapsed
+        '''
+        self.nodes += 1
+        if self.nodes % Connect4Search.CLOCK_NODES == 0 and time.perf_counter() > self.deadline:
+            raise Connect4Search.Timeout()
+
+        # Locals, the class attributes are slower to look up
+        n_cells = Connect4Search.N_CELLS
+        winning_cells = Connect4Search.winning_cells
+
+        possible = (mask + Connect4Search.BOTTOM) & Connect4Search.BOARD
+        opponent = position ^ mask
+        if wins is None:
+            wins = winning_cells(position, mask)
+
+        # Wins now
+        if possible & wins:
+            return (n_cells + 1 - moves) // 2
+
+        if moves >= n_cells - 1:
+            return 0
+
+        threats = winning_cells(opponent, mask)
+        forced = possible & threats
+        if forced:
+            # Two threats, lost
+            if forced & (forced - 1):
+                return -((n_cells - moves) // 2)
+            possible = forced
+
+        # Don't play below a threat
+        possible &= ~(threats >> 1)
+        if not possible:
+            return -((n_cells - moves) // 2)
+
+        if depth == 0:
+            return .01 * (wins.bit_count() - threats.bit_count())
+
+        # Transposition table
+        table = self.table
+        key = position + mask
+        i = key % self.table_size
+        entry = table[i]
+        best_move = None
+        if entry is not None and entry[0] == key:
+            best_move = entry[4]
+            if entry[1] >= depth:
+                if entry[2] == Connect4Search.EXACT:
+                    return entry[3]
+                if entry[2] == Connect4Search.LOWER:
+                    alpha = max(alpha, entry[3])
+                else:
+                    beta = min(beta, entry[3])
+                if alpha >= beta:
+                    return entry[3]
+
+        original_alpha = alpha
+        best_score = -n_cells
+        columns = Connect4Search.COLUMNS
+        col_bits = Connect4Search.COL_BITS
+        # The best move of the table is tried first
+        order = Connect4Search.ORDER if best_move is None else Connect4Search.ORDERS[best_move]
+        for x in order:
+            if not possible & columns[x]:
+                continue
+
+            child_mask = mask | (mask + (1 << (x * col_bits)))
+            score = -self.negamax(opponent, child_mask, moves + 1, depth - 1, -beta, -alpha,
+                    threats & ~child_mask)
+
+            if score > best_score:
+                best_score = score
+                best_move = x
+            if score > alpha:
+                alpha = score
+            if alpha >= beta:
+                break
+
+        if best_score <= original_alpha:
+            flag = Connect4Search.UPPER
+        elif best_score >= beta:
+            flag = Connect4Search.LOWER
+        else:
+            flag = Connect4Search.EXACT
+        table[i] = (key, depth, flag, best_score, best_move)
+
+        return best_score
+
+
+class Connect4Vec(BoardEnvVec):
+    '''
+        n_envs games of Connect4 played with tensor operations only
+    * Wins are detected with a convolution of 4 in a row kernels
+    '''
+    REWARD_WIN = Connect4.REWARD_WIN
+    REWARD_LOOSE = Connect4.REWARD_LOOSE
+    REWARD_DRAW = Connect4.REWARD_DRAW
+    REWARD_NONE = Connect4.REWARD_NONE
+    REWARD_INVALID_ACTION = Connect4.REWARD_INVALID_ACTION
+    WIDTH = Connect4.WIDTH
+    HEIGHT = Connect4.HEIGHT
+    CELL_SYMMETRIES = Connect4.CELL_SYMMETRIES
+    ACTION_SYMMETRIES = Connect4.ACTION_SYMMETRIES
+    SHAPE = [WIDTH, HEIGHT]
+    # [4 lines, 1, x, y] kernels, columns / rows / diagonals
+    # Padded by 3, every line of the board is within a window
+    KERNELS = T.stack([
+        F.pad(T.ones([4, 1]), [0, 3]),
+        F.pad(T.ones([1, 4]), [0, 0, 0, 3]),
+        T.eye(4),
+        T.eye(4).flip(1),
+    ]).unsqueeze(1)
+
+    def __init__(self, n_envs):
+        super().__init__(n_envs, n_state=[Connect4.HEIGHT, Connect4.WIDTH], n_action=Connect4.WIDTH)
+
+    def winners(self, player_id):
+        '''
+            Whether the chips player_id (LongTensor [n_envs]) are aligned
+        - Returns BoolTensor [n_envs]
+        '''
+        planes = (self.state == player_id.view(-1, 1, 1)).to(T.float32).unsqueeze(1)
+        lines = F.conv2d(planes, Connect4Vec.KERNELS, padding=3)
+
+        return (lines >= 4).flatten(1).any(1)
+
+    def play_turn(self, action):
+        '''
+        - Returns reward, done (batched)
+        * action is supposed within 0 and 6 included
+        '''
+        games = T.arange(self.n_envs)
+
+        # The chip falls on the other chips of the column
+        filled = (self.state[games, action] != 0).sum(1)
+        invalid = filled >= Connect4.HEIGHT
+        pos = (Connect4.HEIGHT - 1 - filled).clamp(min=0)
+
+        # The value which represents current player's chip
+        player_id = T.where(self.p1_turn, 1, -1)
+
+        # Update state
+        self.state[games, action, pos] = T.where(invalid, self.state[games, action, pos], player_id)
+
+        # Only the current player can have a new line
+        win = self.winners(player_id) & ~invalid
+        draw = ~win & ~invalid & (self.turns >= Connect4.WIDTH * Connect4.HEIGHT)
+        self.was_draw = draw
+
+        reward = T.full([self.n_envs], float(Connect4.REWARD_NONE))
+        reward[win] = Connect4.REWARD_WIN
+        reward[draw] = Connect4.REWARD_DRAW
+        reward[invalid] = Connect4.REWARD_INVALID_ACTION
+
+        return reward, invalid | win | draw
+
+    def to_str(self):
+        s = []
+        for i in range(self.n_envs):
+            s.append(as_green('P1' if self.p1_turn[i] else 'P2'))
+            s.append(Connect4.to_str(self, self.state[i]))
+
+        return '\n'.join(s)
+
+    @classmethod
+    def legal_actions(cls, states):
+        return states[..., 0] == 0
+
+    @classmethod
+    def random_act(cls):
+        '''
+            Creates a functor that takes valid random actions for
+        a batch of states
+        '''
+        def act(state):
+            return T.multinomial(cls.legal_actions(state).to(T.float32), 1).squeeze(1)
+
+        return act
+
+
+class KInARow(BoardEnv):
+    '''
+        width x height board where the first player to align k chips wins,
+    ie Gomoku (see Gomoku) or Connect4 with any size (see ConnectN)
+    * The state is a [x, y] LongTensor (y = 0 is the top of the board)
+    * With gravity, the actions are columns and chips fall on the other chips,
+    otherwise the actions are cells (x * height + y)
+    * Only the lines through the last chip are checked, a move costs O(k)
+    * The symmetries and legal actions depend on the board, canonical, augment,
+    legal_actions and random_act are methods of the instance (the symmetries
+    are cell_symmetries / action_symmetries instead of the class constants)
+    '''
+    REWARD_WIN = 1
+    REWARD_LOOSE = -1
+    REWARD_DRAW = -.1
+    REWARD_NONE = 0
+    REWARD_INVALID_ACTION = -10
+    # Directions of the lines through a cell (vertical, horizontal and both diagonals)
+    DIRECTIONS = ((0, 1), (1, 0), (1, 1), (1, -1))
+
+    def __init__(self, width, height, k, gravity=False):
+        '''
+        - k : Number of aligned chips to win
+        - gravity : Whether the chips fall on the bottom of their column
+        '''
+        self.width = width
+        self.height = height
+        self.k = k
+        self.gravity = gravity
+
+        if gravity:
+            # Left-right mirror, the actions are columns
+            self.cell_symmetries = grid_symmetries(width, height, rotations=False)
+            self.action_symmetries = T.stack([T.arange(width), T.arange(width).flip(0)])
+        else:
+            # The actions are cells, rotations by 90° are only symmetries of square boards
+            square = width == height
+            self.cell_symmetries = grid_symmetries(width, height, rotations=square, flip_y=not square)
+            self.action_symmetries = self.cell_symmetries.argsort(1)
+
+        super().__init__(n_state=[width, height], n_action=width if gravity else width * height)
+
+    def __aligned(self, x, y, dx, dy, player_id):
+        '''
+            Number of chips player_id after [x, y] in the direction [dx, dy]
+        (at most k - 1)
+        '''
+        n = 0
+        x += dx
+        y += dy
+        while n < self.k - 1 and 0 <= x < self.width and 0 <= y < self.height and \
+                self.board[x * self.height + y] == player_id:
+            n += 1
+            x += dx
+            y += dy
+
+        return n
+
+    def is_winning(self, x, y):
+        '''
+            Whether the chip at [x, y] is within k aligned chips
+        '''
+        player_id = self.board[x * self.height + y]
+        for dx, dy in KInARow.DIRECTIONS:
+            if 1 + self.__aligned(x, y, dx, dy, player_id) + self.__aligned(x, y, -dx, -dy, player_id) >= self.k:
+                return True
+
+        return False
+
+    def play_turn(self, action):
+        '''
+        - Returns reward, done
+        * action is supposed within 0 and n_action excluded
+        '''
+        if self.gravity:
+            x = action
+            y = self.height - 1 - self.heights[x]
+        else:
+            x, y = divmod(action, self.height)
+        cell = x * self.height + y
+
+        # Invalid action (full column or taken cell)
+        if y < 0 or self.board[cell] != 0:
+            return KInARow.REWARD_INVALID_ACTION, True
+
+        # The value which represents current player's chip
+        player_id = 1 if self.p1_turn else -1
+
+        # Update state
+        self.board[cell] = player_id
+        self.state[x, y] = player_id
+        self.update_hash(cell, player_id)
+        if self.gravity:
+            self.heights[x] += 1
+
+        # Only the lines of the new chip can be complete
+        if self.is_winning(x, y):
+            return KInARow.REWARD_WIN, True
+
+        if self.turns >= self.width * self.height:
+            self.was_draw = True
+            return KInARow.REWARD_DRAW, True
+
+        # Not a game end
+        return KInARow.REWARD_NONE, False
+
+    def reset(self):
+        '''
+            Resets the game
+        - Returns state, p1_turn
+        '''
+        super().reset()
+
+        # State for player 1 and the same cells as a list (faster to read)
+        self.state = T.zeros([self.width, self.height], dtype=T.long)
+        self.board = [0] * (self.width * self.height)
+        # Number of chips within each column
+        self.heights = [0] * self.width
+
+        return self.state, self.p1_turn
+
+    def load_board(self, board):
+        self.state = board.clone()
+        self.board = board.flatten().tolist()
+        self.heights = (board != 0).sum(1).tolist()
+
+    def to_str(self, state=None):
+        '''
+        - state : Board to display, the current one by default
+        '''
+        if state is None:
+            state = self.state
+
+        # Column indices, the actions are cells without gravity
+        s = '  ' + ''.join(f'{x % 10:2d}' for x in range(self.width)) + '\n'
+
+        def symbol(c):
+            if c == -1:
+                return as_blue(' O')
+            if c == 1:
+                return as_red(' X')
+            return ' .'
+
+        for y in range(self.height):
+            s += f'{y % 10:2d}' + ''.join(symbol(state[x][y]) for x in range(self.width)) + '\n'
+
+        return s[:-1]
+
+    def legal_actions(self, states):
+        if self.gravity:
+            # The top of the column is empty
+            return states[..., 0] == 0
+
+        return states.flatten(-2) == 0
+
+    def legal_mask(self):
+        if self.gravity:
+            return T.tensor(self.heights) < self.height
+
+        return self.state.flatten() == 0
+
+    def canonical(self, states):
+        return canonical_states(states, self.cell_symmetries)
+
+    def canonical_transitions(self, actions, states, next_states):
+        return canonical_transitions(actions, states, next_states, self.cell_symmetries, self.action_symmetries)
+
+    def augment(self, actions, states, next_states, rewards, dones):
+        return augment_transitions(actions, states, next_states, rewards, dones,
+                self.cell_symmetries, self.action_symmetries)
+
+    def random_act(self):
+        '''
+            Creates a functor that takes valid random actions for this env
+        '''
+        def act(state):
+            return rand.choice(self.legal_actions(state).nonzero()[:, 0].tolist())
+
+        return act
+
+
+class Gomoku(KInARow):
+    '''
+        Five in a row on a size x size board without gravity
+    '''
+    def __init__(self, size=15, k=5):
+        super().__init__(size, size, k, gravity=False)
+
+
+class ConnectN(KInARow):
+    '''
+        Connect4 with any board size and line length, with gravity by default
+    '''
+    def __init__(self, width=7, height=6, k=4, gravity=True):
+        super().__init__(width, height, k, gravity)
@@ -1,3 +1,10 @@
+import csv
+import json
+import math
+import queue
+import threading
+import time
+from profiler import DISABLED
 
 
 def as_red(s):
@@ -28,51 +35,237 @@ def as_yellow(s):
     return '\033[33m' + s + '\033[0m'
 
 
+class Stat:
+    '''
+        Running aggregates of a stream of values (mean, min, max, count)
+    in constant memory
+    '''
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.total = 0.
+        self.min = math.inf
+        self.max = -math.inf
+
+    def add(self, value):
+        '''
+        - value : Float, tensors must be converted before (see Logger.record_loss)
+        '''
+        self.count += 1
+        self.total += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    @property
+    def mean(self):
+        return 0 if self.count == 0 else self.total / self.count
+
+    def state_dict(self):
+        return {'count': self.count, 'total': self.total, 'min': self.min, 'max': self.max}
+
+    def load_state_dict(self, state):
+        self.count = state['count']
+        self.total = state['total']
+        self.min = state['min']
+        self.max = state['max']
+
+
+class MetricsSink:
+    '''
+        Appends rows of metrics (dicts) to a file, written by a background thread
+    * The format is CSV if the path ends with .csv, JSON lines otherwise
+    '''
+    def __init__(self, path):
+        super().__init__()
+
+        self.path = path
+        self.csv = path.endswith('.csv')
+
+        # Rows to write, None stops the writer
+        self.rows = queue.Queue()
+        self.thread = threading.Thread(target=self.__write, daemon=True)
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def write(self, row):
+        '''
+            Queues a row, never blocks
+        '''
+        self.rows.put(row)
+
+    def __write(self):
+        '''
+            Writes the queued rows (writer thread)
+        '''
+        with open(self.path, 'a', newline='') as f:
+            writer = None
+            while True:
+                row = self.rows.get()
+                if row is None:
+                    break
+
+                if not self.csv:
+                    f.write(json.dumps(row) + '\n')
+                else:
+                    # The columns are the keys of the first row
+                    if writer is None:
+                        writer = csv.DictWriter(f, fieldnames=list(row))
+                        if f.tell() == 0:
+                            writer.writeheader()
+                    writer.writerow(row)
+
+                if self.rows.empty():
+                    f.flush()
+
+    def close(self):
+        '''
+            Writes the queued rows and stops the writer thread
+        '''
+        if self.thread.is_alive():
+            self.rows.put(None)
+            self.thread.join()
+
+
 class Logger:
     '''
-        Used to display stats
+        Used to display stats, the data of the games played since the last
+    show is aggregated in constant memory
+    * Also measures the throughput : games, environment steps and learner
+    updates per second
     '''
-    def __init__(self, log_freq):
+    def __init__(self, log_freq, sink=None, profiler=None):
+        '''
+        - sink : MetricsSink, receives the metrics at each show (optional)
+        - profiler : profiler.Profiler used by the training loops, its table
+        is displayed at each show (disabled by default)
+        '''
         self.log_freq = log_freq
+        self.sink = sink
+        self.profiler = DISABLED if profiler is None else profiler
+
+        self.losses = Stat()
+        self.rewards = Stat()
+        self.victories = 0
+        self.draws = 0
 
-        self.losses = []
-        self.rewards = []
-        self.victories = []
-        self.draws = []
+        # Throughput since the last show
+        self.games = 0
+        self.steps = 0
+        self.updates = 0
+        self.last_show = time.perf_counter()
+
+    def record_loss(self, loss):
+        '''
+            Records the loss of a learner update
+        - loss : Float (detached, the graph is not kept)
+        '''
+        self.losses.add(loss)
+        self.updates += 1
+
+    def record_steps(self, n=1):
+        '''
+            Records n environment steps
+        '''
+        self.steps += n
 
     def update(self, epoch, reward, victories, draws):
         '''
-            Appends data on a game and display it if necessary
+            Records data on a game and display it if necessary
         '''
-        self.rewards.append(reward)
-        self.victories.append(victories)
-        self.draws.append(draws)
+        self.rewards.add(reward)
+        self.victories += victories
+        self.draws += draws
+        self.games += 1
 
         if epoch % self.log_freq == 0:
             self.show(epoch)
-    
+
+    def metrics(self, epoch):
+        '''
+            Metrics gathered since the last show (dict)
+        '''
+        elapsed = max(time.perf_counter() - self.last_show, 1e-9)
+
+        return {
+            'epoch': epoch,
+            'time': time.time(),
+            'loss_mean': self.losses.mean,
+            'loss_min': self.losses.min if self.losses.count > 0 else 0,
+            'loss_max': self.losses.max if self.losses.count > 0 else 0,
+            'updates': self.losses.count,
+            'reward_mean': self.rewards.mean,
+            'reward_min': self.rewards.min if self.rewards.count > 0 else 0,
+            'reward_max': self.rewards.max if self.rewards.count > 0 else 0,
+            'games': self.games,
+            'victories': self.victories,
+            'draws': self.draws,
+            'games_per_sec': self.games / elapsed,
+            'steps_per_sec': self.steps / elapsed,
+            'updates_per_sec': self.updates / elapsed,
+        }
+
+    def reset(self):
+        '''
+            Flushes all data
+        '''
+        self.losses.reset()
+        self.rewards.reset()
+        self.victories = 0
+        self.draws = 0
+
+        self.games = 0
+        self.steps = 0
+        self.updates = 0
+        self.last_show = time.perf_counter()
+
+    def state_dict(self):
+        '''
+            Data gathered since the last show (see checkpoint.Checkpointer)
+        '''
+        return {
+            'losses': self.losses.state_dict(),
+            'rewards': self.rewards.state_dict(),
+            'victories': self.victories,
+            'draws': self.draws,
+        }
+
+    def load_state_dict(self, state):
+        self.losses.load_state_dict(state['losses'])
+        self.rewards.load_state_dict(state['rewards'])
+        self.victories = state['victories']
+        self.draws = state['draws']
+
     def show(self, epoch):
         '''
             Displays all informations gathered during training / testing
         * Flushes all data
         '''
-        avg_loss = 0 if len(self.losses) == 0 else sum(self.losses) / len(self.losses)
-        avg_reward = sum(self.rewards) / len(self.rewards)
-        min_reward = min(self.rewards)
-        max_reward = max(self.rewards)
-        victories = sum(self.victories)
+        metrics = self.metrics(epoch)
+        self.reset()
 
-        self.losses.clear()
-        self.rewards.clear()
-        self.draws.clear()
-        self.victories.clear()
+        if self.sink is not None:
+            self.sink.write(metrics)
 
         s = '| '
         s += f'Epoch : {epoch:5d} | '
-        s += f'Average loss : {avg_loss:<7.4f} | '
-        s += f'Average reward : {avg_reward:<5.2f} | '
-        s += f'Min reward : {min_reward:<5.2f} | '
-        s += f'Max reward : {max_reward:<5.2f} | '
-        s += f'Victories : {victories:4d} | '
+        s += f'Average loss : {metrics["loss_mean"]:<7.4f} | '
+        s += f'Average reward : {metrics["reward_mean"]:<5.2f} | '
+        s += f'Min reward : {metrics["reward_min"]:<5.2f} | '
+        s += f'Max reward : {metrics["reward_max"]:<5.2f} | '
+        s += f'Victories : {metrics["victories"]:4d} | '
+        s += f'Games/s : {metrics["games_per_sec"]:<7.1f} | '
+        s += f'Steps/s : {metrics["steps_per_sec"]:<7.1f} | '
+        s += f'Updates/s : {metrics["updates_per_sec"]:<6.1f} | '
 
         print(s)
+
+        if self.profiler.enabled:
+            print(self.profiler.table())
+            self.profiler.reset()
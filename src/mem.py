@@ -1,5 +1,36 @@
 from random import shuffle
 import torch as T
+import torch.multiprocessing as mp
+
+
+def state_storage(size, state_dim, state_preprocessor=None):
+    '''
+        Allocates the storage of size states
+    * If state_preprocessor is given, the states are raw boards
+    stored as int8, otherwise as float32
+    '''
+    return T.empty([size, *state_dim], dtype=T.float32 if state_preprocessor is None else T.int8)
+
+
+def preprocess(states, state_preprocessor=None):
+    '''
+        Preprocesses a batch of stored states
+    '''
+    return states if state_preprocessor is None else state_preprocessor(states.long())
+
+
+def raw_batch(batch, state_preprocessor=None, augment=None):
+    '''
+        Augments then preprocesses a batch of stored trajectories
+    - batch : actions, states, next_states, rewards, dones
+    '''
+    if augment is not None:
+        batch = augment(*batch)
+
+    actions, states, next_states, rewards, dones = batch
+
+    return actions, preprocess(states, state_preprocessor), \
+            preprocess(next_states, state_preprocessor), rewards, dones
 
 
 class LinearMemory:
@@ -8,9 +39,16 @@ class LinearMemory:
     the functor on_learn is called with a batch as parameter.
     All trajectories are learned and have same weights
     '''
-    def __init__(self, state_dim, size, on_learn):
+    def __init__(self, state_dim, size, on_learn, state_preprocessor=None, canonical=None, augment=None):
         '''
         - state_dim : Int list or int, dimension of the state
+        - state_preprocessor : If given, raw states are added and stored as int8,
+        they are preprocessed by batch before on_learn (state_dim is the raw dimension)
+        - canonical : Functor f(actions, states, next_states) -> actions, states, next_states
+        applied to the added trajectories, stores canonical states (see BoardEnv.canonical_transitions)
+        - augment : Functor f(actions, states, next_states, rewards, dones) -> trajectories
+        applied to each learned batch, adds symmetric copies (see BoardEnv.augment)
+        !!! canonical and augment require raw states (state_preprocessor)
         '''
         super().__init__()
 
@@ -20,15 +58,53 @@ class LinearMemory:
 
         self.size = size
         self.on_learn = on_learn
+        self.state_preprocessor = state_preprocessor
+        self.canonical = canonical
+        self.augment = augment
         self.sample_i = 0
 
         self.actions = T.empty([size], dtype=T.long)
-        self.states = T.empty([size, *state_dim])
-        self.next_states = T.empty([size, *state_dim])
+        self.states = state_storage(size, state_dim, state_preprocessor)
+        self.next_states = state_storage(size, state_dim, state_preprocessor)
         self.rewards = T.empty([size])
         self.dones = T.empty([size])
 
+    def __learn(self):
+        '''
+            Learns the whole memory
+        '''
+        # Shuffle data
+        idx = [i for i in range(self.size)]
+        shuffle(idx)
+
+        self.on_learn(*raw_batch((self.actions[idx], self.states[idx], self.next_states[idx],
+                self.rewards[idx], self.dones[idx]), self.state_preprocessor, self.augment))
+
+        # 'Clear' data
+        self.sample_i = 0
+
+    def state_dict(self):
+        '''
+            Content of the memory (see checkpoint.Checkpointer)
+        * The tensors are not copied
+        '''
+        return {
+            'tensors': [self.actions, self.states, self.next_states, self.rewards, self.dones],
+            'sample_i': self.sample_i,
+        }
+
+    def load_state_dict(self, state):
+        for dst, src in zip((self.actions, self.states, self.next_states, self.rewards, self.dones),
+                state['tensors']):
+            dst.copy_(src)
+        self.sample_i = state['sample_i']
+
     def add(self, action, state, next_state, reward, done):
+        if self.canonical is not None:
+            action, state, next_state = self.canonical(T.tensor([action]), state.unsqueeze(0),
+                    next_state.unsqueeze(0))
+            action, state, next_state = action[0], state[0], next_state[0]
+
         self.actions[self.sample_i] = action
         self.states[self.sample_i] = state
         self.next_states[self.sample_i] = next_state
@@ -37,12 +113,474 @@ class LinearMemory:
 
         self.sample_i += 1
         if self.sample_i >= self.size:
-            # Shuffle data
-            idx = [i for i in range(self.size)]
-            shuffle(idx)
+            self.__learn()
+
+    def add_batch(self, actions, states, next_states, rewards, dones):
+        '''
+            Batched version of add, the first dimension of each tensor is the batch
+        '''
+        if self.canonical is not None:
+            actions, states, next_states = self.canonical(actions, states, next_states)
+
+        i = 0
+        n = len(actions)
+        while i < n:
+            # Fill the memory as much as possible
+            count = min(n - i, self.size - self.sample_i)
+            dst = slice(self.sample_i, self.sample_i + count)
+            src = slice(i, i + count)
+
+            self.actions[dst] = actions[src]
+            self.states[dst] = states[src]
+            self.next_states[dst] = next_states[src]
+            self.rewards[dst] = rewards[src]
+            self.dones[dst] = dones[src]
+
+            i += count
+            self.sample_i += count
+            if self.sample_i >= self.size:
+                self.__learn()
+
+
+class SumTree:
+    '''
+        Array backed binary tree where each node is the sum of its children,
+    used for proportional sampling in O(log n)
+    * Operations are batched, the leaves are the priorities
+    '''
+    def __init__(self, size):
+        super().__init__()
+
+        # Number of leaves (power of 2)
+        self.n_leaves = 1
+        self.depth = 0
+        while self.n_leaves < size:
+            self.n_leaves *= 2
+            self.depth += 1
+
+        # Node i has children 2i and 2i + 1, the root is 1
+        self.tree = T.zeros([2 * self.n_leaves], dtype=T.float64)
+
+    def total(self):
+        '''
+            Sum of all priorities
+        '''
+        return self.tree[1].item()
+
+    def get(self, idx):
+        '''
+            Priorities of leaves idx (LongTensor)
+        '''
+        return self.tree[idx + self.n_leaves]
+
+    def update(self, idx, priorities):
+        '''
+            Sets the priorities of leaves idx (LongTensor)
+        '''
+        nodes = idx + self.n_leaves
+        self.tree[nodes] = priorities.to(T.float64)
+
+        # Update parents level by level
+        for _ in range(self.depth):
+            nodes = T.unique(nodes // 2)
+            self.tree[nodes] = self.tree[2 * nodes] + self.tree[2 * nodes + 1]
+
+    def sample(self, n):
+        '''
+            Samples n leaves proportionally to their priorities
+        (stratified sampling, one leaf within each segment of the total)
+        - Returns indices (LongTensor)
+        '''
+        values = (T.arange(n, dtype=T.float64) + T.rand(n, dtype=T.float64)) * (self.total() / n)
+        nodes = T.ones([n], dtype=T.long)
+
+        # Go down from the root
+        for _ in range(self.depth):
+            left = self.tree[2 * nodes]
+            right = values > left
+            values -= left * right
+            nodes = 2 * nodes + right
+
+        return nodes - self.n_leaves
+
+
+class ReplayMemory:
+    '''
+        Circular replay memory, the oldest trajectories are overwritten.
+    on_learn is called with random batches of batch_size trajectories,
+    replay_ratio times per added trajectory on average
+    '''
+    def __init__(self, state_dim, size, batch_size, on_learn, replay_ratio=1., min_size=None,
+                state_preprocessor=None, canonical=None, augment=None):
+        '''
+        - state_dim : Int list or int, dimension of the state
+        - size : Maximum number of trajectories
+        - replay_ratio : Batches learned per added trajectory, can be lower than 1
+        - min_size : Trajectories required before learning, batch_size by default
+        - state_preprocessor : If given, raw states are added and stored as int8,
+        they are preprocessed by batch before on_learn (state_dim is the raw dimension)
+        - canonical / augment : Symmetries of the states, see LinearMemory
+        * The batch tensors given to on_learn are reused between calls (without augment)
+        '''
+        super().__init__()
+
+        # Make compatible int and int list
+        if isinstance(state_dim, int):
+            state_dim = [state_dim]
+
+        self.size = size
+        self.batch_size = batch_size
+        self.on_learn = on_learn
+        self.replay_ratio = replay_ratio
+        self.min_size = batch_size if min_size is None else min_size
+        self.state_preprocessor = state_preprocessor
+        self.canonical = canonical
+        self.augment = augment
+
+        self.sample_i = 0
+        self.count = 0
+        # Batches to learn, can be fractional
+        self.updates = 0.
+
+        self.actions = T.empty([size], dtype=T.long)
+        self.states = state_storage(size, state_dim, state_preprocessor)
+        self.next_states = state_storage(size, state_dim, state_preprocessor)
+        self.rewards = T.empty([size])
+        self.dones = T.empty([size])
+
+        # Batch buffers
+        self.batch = [T.empty([batch_size, *t.shape[1:]], dtype=t.dtype)
+                for t in (self.actions, self.states, self.next_states, self.rewards, self.dones)]
+
+    def state_dict(self):
+        '''
+            Content of the memory (see checkpoint.Checkpointer)
+        * The tensors are not copied
+        '''
+        return {
+            'tensors': [self.actions, self.states, self.next_states, self.rewards, self.dones],
+            'sample_i': self.sample_i,
+            'count': self.count,
+            'updates': self.updates,
+        }
+
+    def load_state_dict(self, state):
+        # Copied, the storage can be shared
+        for dst, src in zip((self.actions, self.states, self.next_states, self.rewards, self.dones),
+                state['tensors']):
+            dst.copy_(src)
+        self.sample_i = state['sample_i']
+        self.count = state['count']
+        self.updates = state['updates']
+
+    def add(self, action, state, next_state, reward, done):
+        self.add_batch(T.tensor([action]), state.unsqueeze(0), next_state.unsqueeze(0),
+                T.tensor([float(reward)]), T.tensor([float(done)]))
+
+    def reserve(self, n):
+        '''
+            Reserves n slots, the oldest ones
+        - Returns the indices of the slots
+        '''
+        idx = (T.arange(n) + self.sample_i) % self.size
+        self.sample_i = (self.sample_i + n) % self.size
+
+        return idx
+
+    def commit(self, idx):
+        '''
+            Called when the trajectories of the slots idx are written,
+        learns if necessary
+        '''
+        n = len(idx)
+        self.count = min(self.count + n, self.size)
+
+        self.updates += n * self.replay_ratio
+        while self.updates >= 1:
+            self.updates -= 1
+            if self.count >= self.min_size:
+                self.learn()
+
+    def add_batch(self, actions, states, next_states, rewards, dones):
+        '''
+            Batched version of add, the first dimension of each tensor is the batch
+        '''
+        if self.canonical is not None:
+            actions, states, next_states = self.canonical(actions, states, next_states)
+
+        n = len(actions)
+        idx = self.reserve(n)
+
+        self.actions[idx] = actions
+        self.states[idx] = states.to(self.states.dtype)
+        self.next_states[idx] = next_states.to(self.next_states.dtype)
+        self.rewards[idx] = rewards
+        self.dones[idx] = dones
+
+        self.commit(idx)
+
+    def sample(self):
+        '''
+            Samples a batch uniformly
+        - Returns idx, weights (None, all trajectories have same weights)
+        '''
+        return T.randint(0, self.count, [self.batch_size]), None
+
+    def gather(self, idx):
+        '''
+            Copies the trajectories idx to the batch buffers (without allocation)
+        - Returns the indices of the copied trajectories
+        '''
+        for src, dst in zip((self.actions, self.states, self.next_states, self.rewards, self.dones), self.batch):
+            T.index_select(src, 0, idx, out=dst)
+
+        return idx
+
+    def learn(self):
+        '''
+            Learns a batch
+        - Returns idx of the batch, result of on_learn
+        '''
+        idx, weights = self.sample()
+        idx = self.gather(idx)
+
+        batch = raw_batch(self.batch, self.state_preprocessor, self.augment)
+
+        if weights is None:
+            return idx, self.on_learn(*batch)
+
+        # Symmetric copies have the weight of their trajectory
+        return idx, self.on_learn(*batch, weights.repeat(len(batch[0]) // self.batch_size))
 
-            self.on_learn(self.actions[idx], self.states[idx], self.next_states[idx], self.rewards[idx], self.dones[idx])
 
-            # 'Clear' data
-            self.sample_i = 0
+class PrioritizedMemory(ReplayMemory):
+    '''
+        Prioritized replay memory, trajectories are sampled proportionally
+    to their TD error. on_learn takes the importance sampling weights as
+    last parameter and returns the new priorities (absolute TD errors)
+    '''
+    def __init__(self, state_dim, size, batch_size, on_learn, replay_ratio=1., min_size=None,
+                state_preprocessor=None, canonical=None, augment=None,
+                alpha=.6, beta=.4, beta_increment=1e-3, eps=1e-2):
+        '''
+        - alpha : How much the priorities are used (0 for uniform sampling)
+        - beta : Importance sampling correction, grows to 1 by beta_increment after each batch
+        - eps : Added to the priorities, every trajectory can be sampled
+        * Other args are super args
+        '''
+        super().__init__(state_dim, size, batch_size, on_learn, replay_ratio, min_size,
+                state_preprocessor, canonical, augment)
+
+        self.alpha = alpha
+        self.beta = beta
+        self.beta_increment = beta_increment
+        self.eps = eps
+
+        self.max_priority = 1.
+        self.priorities = SumTree(size)
+
+    def add_batch(self, actions, states, next_states, rewards, dones):
+        # New trajectories are learned at least once
+        idx = (T.arange(len(actions)) + self.sample_i) % self.size
+        self.priorities.update(idx, T.full([len(actions)], self.max_priority))
+
+        super().add_batch(actions, states, next_states, rewards, dones)
+
+    def sample(self):
+        '''
+            Samples a batch proportionally to the priorities
+        - Returns idx, weights
+        '''
+        idx = self.priorities.sample(self.batch_size).clamp(0, self.count - 1)
+
+        # Importance sampling weights, normalized by the maximum weight
+        probs = self.priorities.get(idx) / self.priorities.total()
+        weights = (self.count * probs) ** -self.beta
+        weights = (weights / weights.max()).to(T.float32)
+
+        self.beta = min(1., self.beta + self.beta_increment)
+
+        return idx, weights
+
+    def state_dict(self):
+        state = super().state_dict()
+        state['priorities'] = self.priorities.tree
+        state['max_priority'] = self.max_priority
+        state['beta'] = self.beta
+
+        return state
+
+    def load_state_dict(self, state):
+        super().load_state_dict(state)
+        self.priorities.tree.copy_(state['priorities'])
+        self.max_priority = state['max_priority']
+        self.beta = state['beta']
+
+    def update_priorities(self, idx, td_errors):
+        '''
+            Sets the priorities of the trajectories idx from their absolute TD errors
+        '''
+        priorities = (td_errors.to(T.float64) + self.eps) ** self.alpha
+        self.max_priority = max(self.max_priority, priorities.max().item())
+        self.priorities.update(idx, priorities)
+
+    def learn(self):
+        '''
+            Learns a batch and updates its priorities
+        '''
+        idx, td_errors = super().learn()
+
+        if td_errors is not None:
+            # The priority of a trajectory is the max over its symmetric copies
+            self.update_priorities(idx, td_errors.view(-1, self.batch_size).max(0)[0])
+
+        return idx, td_errors
+
+
+class SharedMemory(ReplayMemory):
+    '''
+        Replay memory stored in shared memory, several actor processes
+    add trajectories while the learner process learns batches with learn_available
+    * Slots are reserved under a lock, trajectories are written without it
+    * Only written trajectories are sampled : each slot has a version (seqlock)
+    incremented when it is reserved and committed, and a number of pending writes,
+    a slot reserved again before its write is committed is not sampled until
+    its next write (the two writes overlap)
+    * The memory must be created before the actor processes (fork)
+    '''
+    def __init__(self, state_dim, size, batch_size, on_learn=None, replay_ratio=1., min_size=None,
+                state_preprocessor=None, canonical=None, augment=None):
+        '''
+        - on_learn : Used only by the learner
+        * Other args are ReplayMemory args
+        '''
+        # Next slot, number of trajectories, number of added trajectories, number of reserved slots
+        self.counters = T.zeros([4], dtype=T.long).share_memory_()
+        self.lock = mp.Lock()
+
+        super().__init__(state_dim, size, batch_size, on_learn, replay_ratio, min_size,
+                state_preprocessor, canonical, augment)
+
+        for t in (self.actions, self.states, self.next_states, self.rewards, self.dones):
+            t.share_memory_()
+        self.versions = T.zeros([size], dtype=T.long).share_memory_()
+        self.writers = T.zeros([size], dtype=T.long).share_memory_()
+        self.overlapped = T.zeros([size], dtype=T.bool).share_memory_()
+
+        # Added trajectories already used to compute the number of batches (learner only)
+        self.learned = 0
+
+    @property
+    def count(self):
+        return self.counters[1].item()
+
+    @count.setter
+    def count(self, count):
+        self.counters[1] = count
+
+    def state_dict(self):
+        state = super().state_dict()
+        state['counters'] = self.counters
+        state['versions'] = self.versions
+        state['writers'] = self.writers
+        state['overlapped'] = self.overlapped
+        state['learned'] = self.learned
+
+        return state
+
+    def load_state_dict(self, state):
+        super().load_state_dict(state)
+        self.counters.copy_(state['counters'])
+        self.versions.copy_(state['versions'])
+        self.overlapped.copy_(state['overlapped'])
+        # The pending writes of the saved memory are lost
+        self.overlapped |= state['writers'] > 0
+        self.writers.zero_()
+        self.learned = state['learned']
+
+    def reserve(self, n):
+        with self.lock:
+            start = self.counters[0].item()
+            self.counters[0] = (start + n) % self.size
+            self.counters[3] += n
+
+            # Being written
+            idx = (T.arange(n) + start) % self.size
+            self.overlapped[idx] = self.writers[idx] > 0
+            self.writers[idx] += 1
+            self.versions[idx] += 1
+
+        return idx
+
+    def commit(self, idx):
+        '''
+            Called when the trajectories of the slots idx are written, never learns
+        (actors can't learn)
+        '''
+        n = len(idx)
+        with self.lock:
+            self.writers[idx] -= 1
+            self.versions[idx] += 1
+            self.counters[1] = min(self.counters[1].item() + n, self.size)
+            self.counters[2] += n
+
+    def __committed(self, idx):
+        '''
+            Versions of the slots idx, whether they can be sampled
+        '''
+        versions = self.versions[idx]
+
+        return versions, (versions > 0) & (self.writers[idx] == 0) & ~self.overlapped[idx]
+
+    def sample(self):
+        '''
+            Samples a batch uniformly among the written trajectories
+        - Returns idx, weights (None)
+        '''
+        # The slots are reserved in order, the others were never written
+        n = min(self.counters[3].item(), self.size)
+        idx = T.randint(0, n, [self.batch_size])
+
+        # Rejection sampling, only the slots of the pending writes are drawn again
+        _, committed = self.__committed(idx)
+        while not committed.all():
+            idx[~committed] = T.randint(0, n, [int((~committed).sum())])
+            _, committed = self.__committed(idx)
+
+        return idx, None
+
+    def gather(self, idx):
+        '''
+            Copies the trajectories idx, the trajectories written by an actor
+        during the copy are replaced by other ones
+        '''
+        while True:
+            versions, committed = self.__committed(idx)
+            super().gather(idx)
+
+            # The version changes when the slot is reserved again
+            torn = ~committed | (self.versions[idx] != versions)
+            if not torn.any():
+                return idx
+
+            idx = idx.clone()
+            idx[torn] = self.sample()[0][:int(torn.sum())]
+
+    def learn_available(self):
+        '''
+            Learns the batches of all trajectories added since the last call,
+        replay_ratio batches per trajectory
+        - Returns the number of learned batches
+        '''
+        added = self.counters[2].item()
+        self.updates += (added - self.learned) * self.replay_ratio
+        self.learned = added
+
+        n = 0
+        while self.updates >= 1:
+            self.updates -= 1
+            if self.count >= self.min_size:
+                self.learn()
+                n += 1
 
+        return n
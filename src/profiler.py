@@ -0,0 +1,146 @@
+# Opt-in timing of the phases of the training / testing loops
+
+import time
+from contextlib import nullcontext
+import torch as T
+
+
+class Phase:
+    '''
+        Context of a phase of Profiler, reused by all the calls of the phase
+    * The total of a phase nested in itself includes the nested calls twice,
+    its self time is exact
+    '''
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.calls = 0
+        # Total time and time of the nested phases (ns)
+        self.total = 0
+        self.children = 0
+
+    def __enter__(self):
+        # The start is on the stack, a phase can be nested in itself
+        self.profiler.stack.append((self, time.perf_counter_ns()))
+
+    def __exit__(self, *_):
+        stack = self.profiler.stack
+        _, start = stack.pop()
+        elapsed = time.perf_counter_ns() - start
+        self.calls += 1
+        self.total += elapsed
+
+        if len(stack) > 0:
+            stack[-1][0].children += elapsed
+
+
+class Profiler:
+    '''
+        Measures the time spent in named phases with perf_counter_ns,
+    the time of nested phases is not counted in their parent (self time)
+    * A disabled profiler measures nothing, see DISABLED
+    * Used by utils.train (steps), QAgent.learn (updates) and utils.test,
+    the table is printed by the logger at each show
+    * train and test call close, a torch profiler window cut by the end
+    of the loop is still written
+    '''
+    def __init__(self, enabled=True, torch_steps=0, torch_skip=10, trace_path=None):
+        '''
+        - torch_steps : If > 0, the torch profiler records this number
+        of loop steps after torch_skip steps
+        - trace_path : Chrome trace file of the torch profiler, its table
+        is printed if not given
+        '''
+        super().__init__()
+
+        self.enabled = enabled
+        self.torch_steps = torch_steps
+        self.torch_skip = torch_skip
+        self.trace_path = trace_path
+
+        self.phases = {}
+        self.stack = []
+        self.steps = 0
+        self.torch_profiler = None
+        self.empty = nullcontext()
+
+        self.reset()
+
+    def phase(self, name):
+        '''
+            Context that times the phase name
+        '''
+        if not self.enabled:
+            return self.empty
+
+        # The wall time starts with the first phase
+        if self.start is None:
+            self.start = time.perf_counter_ns()
+
+        phase = self.phases.get(name)
+        if phase is None:
+            phase = self.phases[name] = Phase(self, name)
+
+        return phase
+
+    def step(self):
+        '''
+            Called at the end of each step of a loop, starts and
+        stops the torch profiler
+        '''
+        if not self.enabled or self.torch_steps <= 0:
+            return
+
+        self.steps += 1
+        if self.steps == self.torch_skip:
+            self.torch_profiler = T.profiler.profile(activities=[T.profiler.ProfilerActivity.CPU])
+            self.torch_profiler.__enter__()
+        elif self.steps == self.torch_skip + self.torch_steps:
+            self.close()
+
+    def close(self):
+        '''
+            Stops the torch profiler if it is recording and writes its
+        table / trace (see trace_path), the window ends before torch_steps steps
+        '''
+        if self.torch_profiler is None:
+            return
+
+        self.torch_profiler.__exit__(None, None, None)
+        if self.trace_path is None:
+            print(self.torch_profiler.key_averages().table(sort_by='self_cpu_time_total', row_limit=15))
+        else:
+            self.torch_profiler.export_chrome_trace(self.trace_path)
+        self.torch_profiler = None
+
+    def reset(self):
+        '''
+            Clears the measures
+        '''
+        for phase in self.phases.values():
+            phase.calls = phase.total = phase.children = 0
+
+        self.start = None
+
+    def table(self):
+        '''
+            Breakdown of the time since the last reset (string)
+        * 'other' is the time spent outside of any phase
+        '''
+        wall = 1 if self.start is None else max(time.perf_counter_ns() - self.start, 1)
+        rows = sorted(self.phases.values(), key=lambda p: p.total - p.children, reverse=True)
+        other = wall - sum(p.total - p.children for p in rows)
+
+        s = f'| {"Phase":<16} | {"Calls":>8} | {"Self ms":>9} | {"Total ms":>9} | {"Self %":>6} | {"us / call":>9} |\n'
+        for p in rows:
+            if p.calls > 0:
+                s += f'| {p.name:<16} | {p.calls:8d} | {(p.total - p.children) / 1e6:9.1f} | ' \
+                        f'{p.total / 1e6:9.1f} | {(p.total - p.children) / wall * 100:6.1f} | ' \
+                        f'{(p.total - p.children) / p.calls / 1e3:9.1f} |\n'
+        s += f'| {"other":<16} | {"":>8} | {other / 1e6:9.1f} | {"":>9} | {other / wall * 100:6.1f} | {"":>9} |'
+
+        return s
+
+
+# Default profiler of the loggers, measures nothing
+DISABLED = Profiler(enabled=False)
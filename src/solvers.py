@@ -3,19 +3,23 @@
 import envs
 import agents
 import dqn
+from checkpoint import Checkpointer
 from log import Logger
 from mem import LinearMemory
-from utils import f_one_hot_state, play, train, test, random_act, user_act
+from tournament import Tournament
+from utils import f_one_hot_state, f_legal_mask, play, train, test_parallel, random_act, user_act
 
 
 def tic_tac_toe(path='data/tic_tac_toe', seed=161831415):
     # TODO : Complete
     env = envs.TicTacToe()
+    # Games played in parallel for training / testing
+    n_envs = 64
+    vec_env = envs.TicTacToeVec(n_envs)
 
     rand_epochs = 5000
     ai_epochs = 0
 
-    test_games = 100
     mem_size = 200
     log_freq = 500
 
@@ -29,29 +33,34 @@ def tic_tac_toe(path='data/tic_tac_toe', seed=161831415):
     ai = agents.DQNAgent(env.n_state, env.n_action, net,
                         logger=log, lr=5e-4, discount_factor=.92,
                         exploration_decay=.98, exploration_min=.1,
-                        state_preprocessor=f_one_hot_state(depth, -1, flatten=True))
-    mem = LinearMemory(n_state, mem_size, ai.learn)
+                        state_preprocessor=f_one_hot_state(depth, -1, flatten=True),
+                        legal_mask=f_legal_mask(envs.TicTacToe.legal_actions, depth, -1, flatten=True))
+    # Raw boards are memorized, each batch is learned with its 8 symmetric copies
+    mem = LinearMemory(env.n_state, mem_size, ai.learn, state_preprocessor=ai.state_preprocessor,
+            augment=envs.TicTacToe.augment)
     # Train first against random agent
-    rand_act = envs.TicTacToe.random_act()
+    rand_act = envs.TicTacToeVec.random_act()
+    # The opponent receives raw states
+    ai_act = lambda state: ai.act_batch(ai.state_preprocessor(state))
 
     # Loading
     ai.load(path)
 
     # Training
     print('Training vs random')
-    train(ai, rand_act, mem, env, rand_epochs, log, False)
+    train(ai, rand_act, mem, vec_env, rand_epochs, log, False)
     print('Training vs ai')
-    train(ai, ai.act, mem, env, ai_epochs, log, True)
+    train(ai, ai_act, mem, vec_env, ai_epochs, log, True)
 
     # Saving
     ai.save(path)
 
-    # Testing
+    # Testing on every position of the solved game
     ai.exploration_rate = 0
-    win, draw = test(ai.act, rand_act, env, games=test_games, state_preprocessor=ai.state_preprocessor)
+    table = envs.TicTacToeTable.get()
+    optimal = table.score(ai.act_batch, ai.state_preprocessor)
 
-    print(f'Test on {test_games} games : Victories : {win} Draws : {draw}')
-    print(f'Win or draw rate : {(win + draw) / test_games * 100:.1f} %')
+    print(f'Test on {int(table.reachable.sum())} positions : Optimal moves : {optimal * 100:.1f} %')
 
     # Playing
     while 1:
@@ -67,44 +76,56 @@ def tic_tac_toe(path='data/tic_tac_toe', seed=161831415):
 
 def connect4(path='data/connect4', seed=161831415):
     env = envs.Connect4()
+    # Games played in parallel for training / testing
+    n_envs = 64
+    vec_env = envs.Connect4Vec(n_envs)
 
     rand_epochs = 1000
     ai_epochs = 0
 
     test_games = 500
+    # Test processes
+    test_workers = 4
     mem_size = 200
     log_freq = 100
+    # Games between two checkpoints (multiple of log_freq)
+    checkpoint_freq = 500
 
     # 3 states per position
     depth = 3
-    # The state is preprocessed and has this shape now
-    dim_state = [depth, *env.n_state]
     log = Logger(log_freq)
     # Simple dqn
     net = dqn.Conn(depth, env.n_action)
     ai = agents.DQNAgent(env.n_state, env.n_action, net,
                         logger=log, lr=1e-3, discount_factor=.98,
                         exploration_decay=.98, exploration_min=.1,
-                        state_preprocessor=f_one_hot_state(depth, -1, new_size=[1] + dim_state))
-    mem = LinearMemory(dim_state, mem_size, ai.learn)
+                        state_preprocessor=f_one_hot_state(depth, -1, channels_first=True),
+                        legal_mask=f_legal_mask(envs.Connect4.legal_actions, depth, -1, channels_first=True))
+    # Raw boards are memorized
+    mem = LinearMemory(envs.Connect4Vec.SHAPE, mem_size, ai.learn, state_preprocessor=ai.state_preprocessor,
+            augment=envs.Connect4Vec.augment)
     # Train first against random agent
-    rand_act = envs.Connect4.random_act()
+    rand_act = envs.Connect4Vec.random_act()
 
-    # Loading
-    # TODO : ai.load(path)
+    # Loading, training resumes from the last checkpoint
+    checkpoints = Checkpointer(path, keep=3)
+    start = checkpoints.load(ai, mem, log)
 
-    # Training
+    # Training, saved every checkpoint_freq games
     print('Training vs random')
-    train(ai, rand_act, mem, env, rand_epochs, log, False)
+    for epoch in range(start, rand_epochs, checkpoint_freq):
+        train(ai, rand_act, mem, vec_env, min(checkpoint_freq, rand_epochs - epoch), log, False, start_epoch=epoch)
+        checkpoints.save(min(epoch + checkpoint_freq, rand_epochs), ai, mem, log)
     # print('Training vs ai')
     # TODO : train(ai, ai.act, mem, env, ai_epochs, log, True)
 
     # Saving
-    # TODO : ai.save(path)
+    checkpoints.close()
 
     # Testing
     ai.exploration_rate = 0
-    win, draw = test(ai.act, rand_act, env, games=test_games, state_preprocessor=ai.state_preprocessor)
+    win, draw, _ = test_parallel(ai.act_batch, rand_act, vec_env, games=test_games,
+                    state_preprocessor=ai.state_preprocessor, n_workers=test_workers, seed=seed)
 
     print(f'Test on {test_games} games : Victories : {win} Draws : {draw}')
     print(f'Win or draw rate : {(win + draw) / test_games * 100:.1f} %')
@@ -121,16 +142,23 @@ def connect4(path='data/connect4', seed=161831415):
             print('Error / Draw')
 
 
+def connect4_tournament(directory='data/connect4', games=100, n_workers=4, seed=161831415):
+    '''
+        Rates the dqns saved in directory (checkpoints of connect4 or QAgent.save
+    files) against each other and against the built-in actors, the results are cached
+    '''
+    depth = 3
+    env = envs.Connect4()
 
+    def make_agent():
+        return agents.DQNAgent(env.n_state, env.n_action, dqn.Conn(depth, env.n_action),
+                        state_preprocessor=f_one_hot_state(depth, -1, channels_first=True),
+                        legal_mask=f_legal_mask(envs.Connect4.legal_actions, depth, -1, channels_first=True))
 
+    tournament = Tournament(env, games, cache_path=f'{directory}/tournament.json', n_workers=n_workers, seed=seed)
+    tournament.add('random_act', envs.Connect4.random_act())
+    tournament.add('towers_act', envs.Connect4.towers_act())
+    tournament.add_checkpoints(directory, make_agent)
 
-
-
-
-
-
-
-
-
-
-
+    tournament.run()
+    print(tournament.table())
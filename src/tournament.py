@@ -0,0 +1,283 @@
+# Round robin tournaments between agents and their ratings
+
+import hashlib
+import itertools
+import json
+import math
+import os
+import warnings
+import torch as T
+import torch.multiprocessing as mp
+from checkpoint import load_weights
+from utils import gather_results, seed
+
+
+def file_key(path):
+    '''
+        Hash of the content of a file, identifies a checkpoint in the cache
+    '''
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def play_game(a_act, b_act, env, a_first):
+    '''
+        Plays a game between a and b on env
+    - a_act / b_act : Functor f(state) -> action (raw states)
+    - a_first : Whether a plays first (player 1)
+    - Returns the result for a (1 : victory, 0 : draw, -1 : defeat)
+    '''
+    state, _ = env.reset()
+    # The first player is chosen by the tournament
+    env.p1_turn = a_first
+    p1 = a_first
+
+    done = False
+    while not done:
+        action = (a_act if p1 == a_first else b_act)(state)
+        state, reward, done, new_p1 = env.step(action)
+
+        if done:
+            if env.was_draw:
+                return 0
+
+            # The reward is the one of the player that just played
+            p1_won = (p1 and reward > 0) or (not p1 and reward < 0)
+
+            return 1 if p1_won == a_first else -1
+
+        p1 = new_p1
+
+
+def bradley_terry(n_players, results, prior=1e-2, iterations=50):
+    '''
+        Maximum a posteriori strengths of the Bradley-Terry model,
+    P(i beats j) = sigmoid(r[i] - r[j]), draws are half victories
+    - results : Dict (i, j) -> [victories, draws, defeats] of the player i
+    against the player j (indices within [0, n_players))
+    - prior : Weight of the gaussian prior of the strengths, finite
+    strengths for players that never lost or won
+    - Returns strengths (centered), covariance of the strengths (DoubleTensors)
+    '''
+    n = n_players
+    # Points and games of each pairing
+    points = T.zeros([n, n], dtype=T.float64)
+    games = T.zeros([n, n], dtype=T.float64)
+    for (i, j), (win, draw, loss) in results.items():
+        points[i, j] += win + draw / 2
+        points[j, i] += loss + draw / 2
+        games[i, j] += win + draw + loss
+        games[j, i] += win + draw + loss
+
+    # Newton's method, the log posterior is concave
+    r = T.zeros([n], dtype=T.float64)
+    for _ in range(iterations):
+        p = T.sigmoid(r.unsqueeze(1) - r.unsqueeze(0))
+        grad = (points - games * p).sum(1) - prior * r
+        w = games * p * (1 - p)
+        hessian = w - T.diag(w.sum(1)) - prior * T.eye(n, dtype=T.float64)
+        step = T.linalg.solve(hessian, grad)
+        r = r - step
+        if step.abs().max() < 1e-10:
+            break
+
+    # Laplace approximation, the ratings are relative to the average player
+    center = T.eye(n, dtype=T.float64) - 1 / n
+    covariance = center @ T.linalg.inv(-hessian) @ center
+
+    return center @ r, covariance
+
+
+class Tournament:
+    '''
+        Round robin between players, each pairing plays games games on
+    copies of env with alternating first player
+    * The results are cached per pairing in cache_path, only the pairings
+    of new or modified players are played
+    * The pairings are played by n_workers processes, run raises RuntimeError
+    if a worker fails (ie a player raises, see utils.gather_results)
+    '''
+    # Elo points of a factor e in the odds of victory
+    ELO_SCALE = 400 / math.log(10)
+
+    def __init__(self, env, games=100, cache_path=None, n_workers=4, seed=0):
+        '''
+        - env : Non batched environment of the games
+        - games : Number of games of each pairing (even for a fair tournament)
+        - cache_path : JSON file of the results, None disables the cache
+        - seed : Seed of the games, each pairing has its own seed so
+        the results don't depend on n_workers
+        '''
+        super().__init__()
+
+        self.env = env
+        self.games = games
+        self.cache_path = cache_path
+        self.n_workers = n_workers
+        self.seed = seed
+
+        # Name -> [act, key]
+        self.players = {}
+        # (name a, name b) -> [victories, draws, defeats] of a
+        self.results = {}
+        # Pairing key -> cached results, see __cache_key
+        self.cache = {}
+        if cache_path is not None and os.path.exists(cache_path):
+            with open(cache_path) as f:
+                self.cache = json.load(f)
+
+    def add(self, name, act, key=''):
+        '''
+            Adds a player
+        - act : Functor f(state) -> action (raw states), ie envs.Connect4.random_act()
+        - key : Version of the player, its cached results are played
+        again if it changes (ie hash of the weights, see file_key)
+        '''
+        self.players[name] = [act, key]
+
+    def add_checkpoints(self, directory, make_agent, ext=''):
+        '''
+            Adds the dqns saved in directory, by QAgent.save or by
+        checkpoint.Checkpointer, the name of a player is its file name
+        - make_agent : Functor f() -> QAgent with the architecture,
+        state_preprocessor and legal_mask of the checkpoints
+        - ext : Only the files ending with ext are loaded
+        * The files that can't be loaded are skipped with a warning
+        '''
+        # The cache can be within directory
+        cache = None if self.cache_path is None else os.path.abspath(self.cache_path)
+
+        for name in sorted(os.listdir(directory)):
+            path = os.path.join(directory, name)
+            if not os.path.isfile(path) or not name.endswith(ext) or \
+                    os.path.abspath(path) in (cache, f'{cache}.tmp'):
+                continue
+
+            agent = make_agent()
+            try:
+                agent.dqn.load_state_dict(load_weights(path))
+            except Exception as e:
+                warnings.warn(f'Skipped {path}, not a dqn of the players : {e}')
+                continue
+            agent.reset_inference()
+
+            agent.exploration_rate = 0
+            self.add(name, lambda state, agent=agent: agent.act(agent.state_preprocessor(state)), file_key(path))
+
+    def run(self):
+        '''
+            Plays the pairings that are not cached
+        - Returns results (see self.results)
+        '''
+        # Sorted, the cache doesn't depend on the order of the players
+        pairings = list(itertools.combinations(sorted(self.players), 2))
+
+        todo = []
+        for pairing in pairings:
+            cached = self.cache.get(self.__cache_key(*pairing))
+            if cached is None:
+                todo.append(pairing)
+            else:
+                self.results[pairing] = cached
+
+        if len(todo) > 0:
+            ctx = mp.get_context('fork')
+            jobs = ctx.Queue()
+            results = ctx.Queue()
+
+            for pairing in todo:
+                jobs.put(pairing)
+            for _ in range(self.n_workers):
+                jobs.put(None)
+
+            workers = [ctx.Process(target=self.__worker, args=(jobs, results))
+                    for _ in range(min(self.n_workers, len(todo)))]
+            for worker in workers:
+                worker.start()
+
+            for pairing, pairing_results in gather_results(results, workers, len(todo)):
+                self.results[pairing] = pairing_results
+                self.cache[self.__cache_key(*pairing)] = pairing_results
+
+            for worker in workers:
+                worker.join()
+
+            self.__save_cache()
+
+        return self.results
+
+    def ratings(self, base=1500, z=1.96):
+        '''
+            Elo ratings of the players (Bradley-Terry model, see bradley_terry)
+        - base : Rating of the average player
+        - z : Quantile of the confidence intervals, 1.96 for 95 %
+        - Returns a list of (name, rating, margin) sorted by rating,
+        the interval is [rating - margin, rating + margin]
+        '''
+        names = list(self.players)
+        index = {name: i for i, name in enumerate(names)}
+        results = {(index[a], index[b]): r for (a, b), r in self.results.items()
+                if a in index and b in index}
+
+        strengths, covariance = bradley_terry(len(names), results)
+        ratings = base + Tournament.ELO_SCALE * strengths
+        margins = z * Tournament.ELO_SCALE * covariance.diag().clamp(min=0).sqrt()
+
+        return sorted(zip(names, ratings.tolist(), margins.tolist()), key=lambda r: r[1], reverse=True)
+
+    def table(self):
+        '''
+            Ratings and scores of the players (string)
+        '''
+        score = {name: [0, 0, 0] for name in self.players}
+        for (a, b), (win, draw, loss) in self.results.items():
+            score[a] = [score[a][0] + win, score[a][1] + draw, score[a][2] + loss]
+            score[b] = [score[b][0] + loss, score[b][1] + draw, score[b][2] + win]
+
+        width = max([len(name) for name in self.players] + [6])
+        s = f'| {"Player":<{width}} | {"Elo":>6} | {"95 %":>6} | {"W":>5} | {"D":>5} | {"L":>5} |'
+        for name, rating, margin in self.ratings():
+            win, draw, loss = score[name]
+            s += f'\n| {name:<{width}} | {rating:6.0f} | {margin:6.0f} | {win:5d} | {draw:5d} | {loss:5d} |'
+
+        return s
+
+    def __cache_key(self, a, b):
+        '''
+            Key of the pairing in the cache, depends on the players' versions
+        and on the number of games
+        '''
+        return json.dumps([a, self.players[a][1], b, self.players[b][1], self.games])
+
+    def __save_cache(self):
+        if self.cache_path is None:
+            return
+
+        # Atomic, an interrupted write keeps the previous cache
+        tmp = self.cache_path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.cache, f)
+        os.replace(tmp, self.cache_path)
+
+    def __worker(self, jobs, results):
+        '''
+            Worker process of run, plays the pairings of jobs until None
+        '''
+        # The processes share the cores
+        T.set_num_threads(1)
+
+        while True:
+            pairing = jobs.get()
+            if pairing is None:
+                return
+
+            a, b = pairing
+            # Same games whatever the worker
+            seed(self.seed + int(hashlib.sha1(json.dumps(pairing).encode()).hexdigest()[:8], 16))
+
+            score = [0, 0, 0]
+            for g in range(self.games):
+                result = play_game(self.players[a][0], self.players[b][0], self.env, g % 2 == 0)
+                score[1 - result] += 1
+
+            results.put((pairing, score))
@@ -1,18 +1,45 @@
+import copy
+import queue
 import random as rand
+import threading
 import torch.nn.functional as F
 import torch as T
+import torch.multiprocessing as mp
+from profiler import DISABLED
 
 
-def f_one_hot_state(depth, min_depth, new_size=None):
+def f_one_hot_state(depth, min_depth, new_size=None, flatten=False, channels_first=False):
     '''
         Functor for one_hot_state
+    - flatten : If True, the one hot dimension is merged with the last
+    dimension of the state (works with batches of states)
+    - channels_first : If True, 2D states are encoded as [depth, x, y]
+    images for convolutions (works with batches of states)
     '''
     if new_size is not None:
         return lambda state: one_hot_state(state, depth, min_depth).view(*new_size)
+    elif flatten:
+        return lambda state: one_hot_state(state, depth, min_depth).flatten(-2)
+    elif channels_first:
+        return lambda state: one_hot_state(state, depth, min_depth).movedim(-1, -3).contiguous()
     else:
         return lambda state: one_hot_state(state, depth, min_depth)
 
 
+def f_legal_mask(legal_actions, depth, min_depth, flatten=False, channels_first=False):
+    '''
+        Functor f(states) -> masks of the legal actions of a batch of states
+    preprocessed by f_one_hot_state (same args)
+    - legal_actions : Masks of raw states, ie envs.TicTacToe.legal_actions
+    '''
+    if flatten:
+        return lambda states: legal_actions(states.unflatten(-1, (-1, depth)).argmax(-1) + min_depth)
+    elif channels_first:
+        return lambda states: legal_actions(states.argmax(-3) + min_depth)
+    else:
+        return lambda states: legal_actions(states.argmax(-1) + min_depth)
+
+
 def one_hot_state(state, depth, min_depth):
     '''
         Returns the one hot encoded state (tensor of type float32)
@@ -31,6 +58,33 @@ def seed(seed):
     T.manual_seed(seed)
 
 
+def random_states(env, n, state_preprocessor=lambda x: x):
+    '''
+        Batch of n preprocessed states of random games played on env,
+    ie to calibrate quantized agents (see QAgent.quantize)
+    '''
+    act = env.random_act()
+    states = []
+    count = 0
+    if env.batched:
+        obs, _ = env.reset()
+        while count < n:
+            states.append(obs.clone())
+            count += len(obs)
+            env.step(act(obs))
+            obs = env.obs
+    else:
+        while count < n:
+            state, _ = env.reset()
+            done = False
+            while not done and count < n:
+                states.append(state.unsqueeze(0).clone())
+                count += 1
+                state, _, done, _ = env.step(act(state))
+
+    return state_preprocessor(T.cat(states)[:n])
+
+
 def random_act(n_action):
     '''
         Returns a functor which takes random actions
@@ -95,35 +149,149 @@ def play(p1_act, p2_act, env, render=True, state_preprocessor=lambda x: x):
     return total_p1_reward, total_p2_reward
 
 
-def test(p1_act, p2_act, env, games=100, state_preprocessor=lambda x: x):
+def test(p1_act, p2_act, env, games=100, state_preprocessor=lambda x: x, profiler=DISABLED):
     '''
         Tests p1 on several games on env
     - p1_act / p2_act : Functor f(state) -> action
+    - profiler : profiler.Profiler, times the phases of the games (optional)
     - Returns (victories, draws)
     !!! Set exploration rate to 0 for accurate test
+    * If env is batched, p1_act and p2_act take batches of states
+    '''
+    results = test_results(p1_act, p2_act, env, games, state_preprocessor, profiler)
+
+    return results.count(1), results.count(0)
+
+
+def test_results(p1_act, p2_act, env, games=100, state_preprocessor=lambda x: x, profiler=DISABLED):
     '''
-    victories = 0
-    draws = 0
+        Same as test but returns the result of each game for p1
+    (1 : victory, 0 : draw, -1 : defeat)
+    '''
+    if env.batched:
+        results = _test_batched(p1_act, p2_act, env, games, state_preprocessor, profiler)
+        profiler.close()
+
+        return results
+
+    results = []
     for _ in range(games):
         state, p1 = env.reset()
         done = False
         while not done:
             # TODO : Preprocessing
-            action = (p1_act if p1 else p2_act)(state_preprocessor(state) if p1 else state)
-            state, reward, done, new_p1 = env.step(action)
+            with profiler.phase('act'):
+                action = (p1_act if p1 else p2_act)(state_preprocessor(state) if p1 else state)
+            with profiler.phase('env step'):
+                state, reward, done, new_p1 = env.step(action)
+            profiler.step()
 
             if done:
                 if env.was_draw:
-                    draws += 1
+                    results.append(0)
                 elif (p1 and reward > 0) or (not p1 and reward < 0):
-                    victories += 1
+                    results.append(1)
+                else:
+                    results.append(-1)
 
             p1 = new_p1
 
-    return victories, draws
+    profiler.close()
+
+    return results
+
+
+def gather_results(results, workers, n, timeout=1):
+    '''
+        Gets n items of the queue results filled by the processes workers
+    - timeout : Seconds between two checks of the workers
+    !!! Raises RuntimeError if a worker exits before sending its results
+    (ie an exception within the worker) instead of waiting forever
+    '''
+    items = []
+    while len(items) < n:
+        try:
+            items.append(results.get(timeout=timeout))
+        except queue.Empty:
+            # The results of a worker are sent before it exits with code 0
+            failed = [worker.exitcode for worker in workers if worker.exitcode not in (None, 0)]
+            if len(failed) > 0 or all(worker.exitcode == 0 for worker in workers):
+                for worker in workers:
+                    worker.terminate()
+                raise RuntimeError(f'Worker process exited with code {failed[0] if len(failed) > 0 else 0} '
+                        'before sending its results')
+
+    return items
+
+
+def _tester(p1_act, p2_act, env, games, state_preprocessor, seed_value, rank, results):
+    '''
+        Worker process of test_parallel
+    '''
+    # The processes share the cores
+    T.set_num_threads(1)
+    seed(seed_value)
+
+    results.put((rank, test_results(p1_act, p2_act, env, games, state_preprocessor)))
+
+
+def test_parallel(p1_act, p2_act, env, games=100, state_preprocessor=lambda x: x, n_workers=2, seed=0):
+    '''
+        Parallel version of test, games are split between n_workers processes
+    playing on copies of env
+    - seed : Seed of the first worker (worker i uses seed + i), results are
+    reproducible for a given seed and n_workers
+    - Returns victories, draws, results (see test_results, in worker order)
+    !!! Raises RuntimeError if a worker fails (see gather_results)
+    '''
+    ctx = mp.get_context('fork')
+    results = ctx.Queue()
+
+    workers = []
+    for i in range(n_workers):
+        # The first workers play one more game if necessary
+        worker_games = games // n_workers + (i < games % n_workers)
+        workers.append(ctx.Process(target=_tester, args=(p1_act, p2_act, env, worker_games,
+                state_preprocessor, seed + i, i, results)))
+
+    for worker in workers:
+        worker.start()
+
+    worker_results = dict(gather_results(results, workers, len(workers)))
+    for worker in workers:
+        worker.join()
+
+    results = [r for i in range(n_workers) for r in worker_results[i]]
+
+    return results.count(1), results.count(0), results
+
+
+def test_threaded(p1_act, p2_act, env, games=100, state_preprocessor=lambda x: x, n_threads=8):
+    '''
+        Threaded version of test, games are split between n_threads threads
+    playing on copies of env
+    * Used with agents.InferenceBatcher, the actions of all threads are batched
+    !!! Results are not reproducible, threads share the random generators
+    - Returns victories, draws, results (see test_results, in thread order)
+    '''
+    results = [None] * n_threads
+
+    def worker(i, games):
+        results[i] = test_results(p1_act, p2_act, copy.deepcopy(env), games, state_preprocessor)
 
+    threads = [threading.Thread(target=worker, args=(i, games // n_threads + (i < games % n_threads)))
+            for i in range(n_threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
 
-def train(p1, p2_act, mem, env, epochs, logger, train_p2=True):
+    results = [r for thread_results in results for r in thread_results]
+
+    return results.count(1), results.count(0), results
+
+
+def train(p1, p2_act, mem, env, epochs, logger, train_p2=True, start_epoch=0):
     '''
         Trains p1 on several games on env
     - p1 : Agent
@@ -131,45 +299,349 @@ def train(p1, p2_act, mem, env, epochs, logger, train_p2=True):
     - mem : Memory
     - logger : Used to display stats
     - train_p2 : If True, adds also p2's trajectories
-    * The state is preprocessed by p1
+    - start_epoch : Epochs already played, ie when training resumes from a checkpoint
+    (the logged epochs are start_epoch + 1 ... start_epoch + epochs)
+    * The state is preprocessed by p1, or by mem if it has a state_preprocessor
+    (raw states are memorized)
+    * If env is batched, p2_act takes batches of states
     '''
+    if env.batched:
+        _train_batched(p1, p2_act, mem, env, epochs, logger, train_p2, start_epoch)
+        logger.profiler.close()
+
+        return
+
+    # The memory preprocesses raw states itself
+    raw = mem.state_preprocessor is not None
+    profiler = logger.profiler
+
     # TODO : Save
-    for e in range(1, epochs + 1):
+    for e in range(start_epoch + 1, start_epoch + epochs + 1):
         total_reward = 0
         done = False
         old_p1_state = None
         old_p2_state = None
 
         state, p1_turn = env.reset()
+        # Copied since the env can modify its state
+        raw_state = state.clone() if raw else None
         if p1_turn:
-            state = p1.state_preprocessor(state)
+            with profiler.phase('preprocess'):
+                state = p1.state_preprocessor(state)
 
         while not done:
-            act = p1.act if p1_turn else p2_act
-            action = act(state)
+            with profiler.phase('act'):
+                action = p1.act(state, mask=env.legal_mask()) if p1_turn else p2_act(state)
 
-            new_state, reward, done, new_p1_turn = env.step(action)
+            with profiler.phase('env step'):
+                new_state, reward, done, new_p1_turn = env.step(action)
+                raw_new_state = new_state.clone() if raw else None
+            logger.record_steps()
 
             # TODO : For p2
             if new_p1_turn:
-                new_state = p1.state_preprocessor(new_state)
+                with profiler.phase('preprocess'):
+                    new_state = p1.state_preprocessor(new_state)
 
             # Add trajectories in parallel
             if p1_turn:
-                old_p1_state = state
+                old_p1_state = raw_state if raw else state
                 total_reward += reward
             else:
-                old_p2_state = state
+                old_p2_state = raw_state if raw else state
 
             # TODO : Train p2
-            if new_p1_turn:
-                if old_p1_state is not None:
-                    mem.add(action, old_p1_state, new_state, reward, done)
-            elif old_p2_state is not None and train_p2:
-                    mem.add(action, old_p2_state, new_state, reward, done)
+            with profiler.phase('mem add'):
+                if new_p1_turn:
+                    if old_p1_state is not None:
+                        mem.add(action, old_p1_state, raw_new_state if raw else new_state, reward, done)
+                elif old_p2_state is not None and train_p2:
+                        mem.add(action, old_p2_state, raw_new_state if raw else new_state, reward, done)
 
             state = new_state
+            raw_state = raw_new_state
             p1_turn = new_p1_turn
+            profiler.step()
 
         victory = int(not env.was_draw and ((p1 and reward > 0) or (not p1 and reward < 0)))
         logger.update(e, total_reward, victory, int(env.was_draw))
+
+    profiler.close()
+
+
+def _act_batched(p1_act, p2_act, obs, p1_turn, state_preprocessor):
+    '''
+        Actions of all games of a batched env, p1 plays where p1_turn is True
+    '''
+    action = p2_act(obs)
+    if p1_turn.any():
+        action[p1_turn] = p1_act(state_preprocessor(obs[p1_turn]))
+
+    return action
+
+
+def _p1_won(env, reward, done, p1_turn):
+    '''
+        Whether p1 won the finished games of a batched env
+    - p1_turn : Turn before the step
+    '''
+    return done & ~env.was_draw & T.where(p1_turn, reward > 0, reward < 0)
+
+
+def _test_batched(p1_act, p2_act, env, games, state_preprocessor, profiler=DISABLED):
+    '''
+        test_results for batched environments, plays env.n_envs games at once
+    '''
+    results = []
+    obs, p1_turn = env.reset()
+
+    # Games whose result is counted, a finished game is replaced while
+    # less than games games have started (the longest games are counted too)
+    active = T.arange(env.n_envs) < games
+    started = int(active.sum())
+    while active.any():
+        with profiler.phase('act'):
+            action = _act_batched(p1_act, p2_act, obs, p1_turn, state_preprocessor)
+        with profiler.phase('env step'):
+            _, reward, done, new_p1_turn = env.step(action)
+        profiler.step()
+
+        ended = done & active
+        if ended.any():
+            # 1 for victories, 0 for draws and -1 for defeats
+            won = _p1_won(env, reward, done, p1_turn)
+            result = won.long() * 2 - 1
+            result[env.was_draw] = 0
+            results += result[ended].tolist()
+
+            # The new games of the first finished slots are counted
+            slots = ended.nonzero()[:, 0]
+            replaced = slots[:games - started]
+            started += len(replaced)
+            active[slots[len(replaced):]] = False
+
+        obs = env.obs
+        p1_turn = new_p1_turn
+
+    return results
+
+
+def _train_batched(p1, p2_act, mem, env, epochs, logger, train_p2=True, start_epoch=0):
+    '''
+        train for batched environments, plays env.n_envs games at once
+    * Trajectories are added to mem by batches, the transition of a player
+    ends when the opponent has played
+    '''
+    games = T.arange(env.n_envs)
+    # Whether the trajectories of each player are memorized
+    memorized = T.tensor([True, train_p2])
+    # Last move of each player [player, game], waiting for the opponent's move
+    pending = T.zeros([2, env.n_envs], dtype=T.bool)
+    pending_actions = T.zeros([2, env.n_envs], dtype=T.long)
+    pending_states = None
+    total_rewards = T.zeros([env.n_envs])
+    # The memory preprocesses raw states itself
+    raw = mem.state_preprocessor is not None
+    profiler = logger.profiler
+
+    e = start_epoch
+    end = start_epoch + epochs
+    obs, p1_turn = env.reset()
+    while e < end:
+        with profiler.phase('preprocess'):
+            state = obs if raw else p1.state_preprocessor(obs)
+        if pending_states is None:
+            pending_states = T.zeros([2, *state.shape], dtype=state.dtype)
+
+        with profiler.phase('act'):
+            masks = env.legal_mask()[p1_turn]
+            action = _act_batched(lambda states: p1.act_batch(states, masks), p2_act, obs, p1_turn,
+                    p1.state_preprocessor if raw else lambda _: state[p1_turn])
+        with profiler.phase('env step'):
+            new_state, reward, done, new_p1_turn = env.step(action)
+        logger.record_steps(env.n_envs)
+        if not raw:
+            with profiler.phase('preprocess'):
+                new_state = p1.state_preprocessor(new_state)
+
+        # 0 for p1, 1 for p2
+        player = (~p1_turn).long()
+        opponent = 1 - player
+
+        # Reward of the opponent when the game is finished by this move
+        opponent_reward = T.full_like(reward, env.REWARD_NONE)
+        opponent_reward[reward == env.REWARD_WIN] = env.REWARD_LOOSE
+        opponent_reward[env.was_draw] = env.REWARD_DRAW
+
+        with profiler.phase('mem add'):
+            # The opponent's transitions end now
+            ended = pending[opponent, games] & memorized[opponent]
+            if ended.any():
+                mem.add_batch(pending_actions[opponent, games][ended],
+                        pending_states[opponent, games][ended], new_state[ended],
+                        opponent_reward[ended], done[ended].float())
+            pending[opponent, games] = False
+
+            # Last transitions of the player who just played
+            ended = done & memorized[player]
+            if ended.any():
+                mem.add_batch(action[ended], state[ended], new_state[ended],
+                        reward[ended], done[ended].float())
+
+        # Other transitions wait for the opponent's move
+        waiting = ~done
+        pending[player[waiting], games[waiting]] = True
+        pending_actions[player[waiting], games[waiting]] = action[waiting]
+        pending_states[player[waiting], games[waiting]] = state[waiting]
+
+        # Stats for p1
+        total_rewards += T.where(p1_turn, reward, opponent_reward)
+        if done.any():
+            victories = _p1_won(env, reward, done, p1_turn)
+            for i in games[done].tolist():
+                if e >= end:
+                    break
+
+                e += 1
+                logger.update(e, total_rewards[i].item(), int(victories[i]), int(env.was_draw[i]))
+
+            total_rewards[done] = 0
+
+        obs = env.obs
+        p1_turn = new_p1_turn
+        profiler.step()
+
+
+class _QueueLogger:
+    '''
+        Logger of the actors of train_parallel, sends game stats to the learner
+    '''
+    def __init__(self, results):
+        self.results = results
+        self.profiler = DISABLED
+        # Steps not sent yet
+        self.steps = 0
+
+    def record_steps(self, n=1):
+        self.steps += n
+
+    def update(self, epoch, reward, victories, draws):
+        self.results.put((reward, victories, draws, self.steps))
+        self.steps = 0
+
+
+def _actor(agent, p2_act, mem, env, train_p2, sync_freq, weights, shared, lock, results, seed_value,
+            quantize_states, quantize_refresh):
+    '''
+        Actor process of train_parallel, plays games with the last published weights
+    '''
+    # The processes share the cores
+    T.set_num_threads(1)
+    seed(seed_value)
+
+    # The int8 copy follows the shared weights, the float dqn of the agent is never
+    # written and its pages stay shared with the learner (fork)
+    if quantize_states is not None:
+        with lock:
+            agent.quantize(quantize_states, quantize_refresh, weights)
+
+    logger = _QueueLogger(results)
+    version = -1
+    while shared[2] == 0:
+        # Synchronize weights
+        if shared[0] != version:
+            with lock:
+                if agent.quantized is None:
+                    agent.dqn.load_state_dict(weights.state_dict())
+                agent.reset_inference()
+                agent.refresh_quantized()
+                agent.exploration_rate = shared[1].item()
+                version = shared[0].item()
+
+        train(agent, p2_act, mem, env, sync_freq, logger, train_p2)
+
+
+def train_parallel(p1, p2_act, mem, env, epochs, logger, train_p2=True, n_actors=2,
+                    sync_freq=10, publish_freq=10, seed=None, quantize_states=None, quantize_refresh=1):
+    '''
+        Trains p1 with n_actors processes playing games on copies of env,
+    this process learns the trajectories
+    - mem : SharedMemory, p1 learns its batches
+    - epochs : Total number of games
+    - sync_freq : Games played by an actor between two weight synchronizations
+    - publish_freq : Batches learned between two weight publications
+    - seed : Seed of the first actor (actor i uses seed + i), random by default
+    - quantize_states : If given, the actors act with int8 copies of the weights
+    calibrated on these preprocessed states (see QAgent.quantize, random_states),
+    an actor then holds the int8 dqn and its trace but no float copy of the weights
+    - quantize_refresh : Weight syncs between two refreshes of the int8 copies,
+    the actors act on weights up to quantize_refresh * sync_freq games old
+    * Other args are train args, env can be batched
+    !!! Raises RuntimeError if an actor fails
+    '''
+    ctx = mp.get_context('fork')
+
+    # Weights read by the actors
+    weights = copy.deepcopy(p1.dqn).share_memory()
+    # Version of the weights, exploration rate, stop flag
+    shared = T.tensor([0., p1.exploration_rate, 0.]).share_memory_()
+    lock = ctx.Lock()
+    results = ctx.Queue()
+    if seed is None:
+        seed = rand.randint(0, 2 ** 31)
+
+    actors = [ctx.Process(target=_actor, args=(p1, p2_act, mem, env, train_p2, sync_freq,
+                weights, shared, lock, results, seed + i, quantize_states, quantize_refresh))
+            for i in range(n_actors)]
+    for actor in actors:
+        actor.start()
+
+    e = 0
+    learned = 0
+    published = 0
+    while e < epochs:
+        # The actors only exit when stopped, otherwise they failed and nothing would be learned
+        failed = [actor.exitcode for actor in actors if actor.exitcode is not None]
+        if len(failed) > 0:
+            for actor in actors:
+                actor.terminate()
+            raise RuntimeError(f'Actor process exited with code {failed[0]} during training')
+
+        n = mem.learn_available()
+        learned += n
+
+        # Publish weights
+        if learned - published >= publish_freq:
+            with lock:
+                weights.load_state_dict(p1.dqn.state_dict())
+                shared[0] += 1
+                shared[1] = p1.exploration_rate
+            published = learned
+
+        # Stats of the games already played by the actors, waits if there is nothing to learn
+        block = n == 0
+        for _ in range(max(1, results.qsize())):
+            if e >= epochs:
+                break
+
+            try:
+                reward, victory, draw, steps = results.get(block, timeout=1e-2)
+            except queue.Empty:
+                break
+
+            e += 1
+            block = False
+            logger.record_steps(steps)
+            logger.update(e, reward, victory, draw)
+
+    # Stop actors, the queue is emptied to let them exit
+    shared[2] = 1
+    while any(actor.is_alive() for actor in actors):
+        try:
+            while True:
+                results.get_nowait()
+        except queue.Empty:
+            pass
+
+        for actor in actors:
+            actor.join(1e-2)